@@ -0,0 +1,249 @@
+import os
+import threading
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from typing import *
+
+# Shared compute service of the server.
+# All the sessions of the Streamlit server submit their simulations to one
+# bounded process pool, so the work scales with the number of cores instead
+# of competing for the GIL in the script threads. Identical requests that
+# are queued or running are coalesced into a single computation. Every
+# session sticks to the worker process of its last request while it is free,
+# so the caches of that process (e.g. the simulation pipelines) are reused.
+
+
+class ServiceBusy(RuntimeError):
+    """
+    Raised when the request queue of the compute service is full.
+    """
+
+
+def request_key(request:Any) -> Hashable:
+    """
+    Converts a request (nested dicts, lists, tuples, arrays and scalars) to a
+    hashable key, equal for equal requests.
+    """
+    if isinstance(request, dict):
+        return tuple(sorted((key, request_key(value))
+                            for key, value in request.items()))
+    if isinstance(request, (list, tuple)):
+        return tuple(request_key(value) for value in request)
+    if isinstance(request, np.ndarray):
+        return (request.dtype.str, request.shape, request.tobytes())
+    if isinstance(request, np.generic):
+        return request.item()
+    return request
+
+
+class ComputeService:
+    """
+    Bounded process pool behind a request queue.
+
+    Every session has its own queue and the sessions are served round robin,
+    so a session that submits many requests does not delay the others. A new
+    request of a session replaces its requests that are still queued (e.g.
+    the reruns of a dragged slider), unless another session shares them.
+    When the total queue depth reaches `max_queue_depth`, new requests are
+    rejected with ServiceBusy.
+
+    Every worker is a single process pool, so a request can be sent to the
+    worker that ran the previous request of its session. A pool whose
+    process died (e.g. killed when out of memory) is replaced by a new one:
+    the request it was running fails with BrokenProcessPool and the next
+    requests run in the new process.
+
+    Arguments:
+    ---------
+    max_workers: int -> Number of worker processes (the number of cores by
+        default)
+
+    max_queue_depth: int -> Maximum number of requests waiting for a worker
+    """
+
+    def __init__(self, max_workers:Optional[int] = None,
+                 max_queue_depth:int = 32):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue_depth = max_queue_depth
+        self._workers = [ProcessPoolExecutor(1)
+                         for _ in range(self.max_workers)]
+        self._busy = [False] * self.max_workers
+        # Worker of the last request of every session
+        self._affinity = {}
+        # Reentrant, a worker future that is already done runs its callback
+        # inside the dispatch loop
+        self._lock = threading.RLock()
+        self._queues = OrderedDict()
+        self._pending = {}
+        # Sessions waiting for every pending request
+        self._subscribers = {}
+        self.coalesced = 0
+        self.replaced = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of requests waiting for a worker.
+        """
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def running(self) -> int:
+        """
+        Number of requests being computed.
+        """
+        with self._lock:
+            return sum(self._busy)
+
+    def submit(self, session_id:Hashable, key:Hashable,
+               fn:Callable, *args) -> Future:
+        """
+        Queues the computation fn(*args) for the session.
+
+        Arguments:
+        ---------
+        session_id: Hashable -> Identifier of the session
+
+        key: Hashable -> Identifier of the computation (see `request_key`),
+            requests with the key of a pending request share its result
+
+        fn: Callable -> Picklable function run in a worker process
+
+        Returns:
+        -------
+        Future -> Result of the computation, the future is cancelled if a
+            newer request of the session replaces it before it runs
+        """
+        with self._lock:
+            self._replace_queued(session_id, key)
+
+            if key in self._pending:
+                self.coalesced += 1
+                self._subscribers[key].add(session_id)
+                return self._pending[key]
+
+            if sum(len(queue) for queue in self._queues.values()) >= \
+                    self.max_queue_depth:
+                raise ServiceBusy("The compute service queue is full")
+
+            future = Future()
+            self._pending[key] = future
+            self._subscribers[key] = {session_id}
+            self._queues.setdefault(session_id, deque()).append(
+                                                            (key, fn, args))
+            self._dispatch()
+        return future
+
+    def _replace_queued(self, session_id:Hashable, key:Hashable):
+        """
+        Cancels the queued requests of the session other than `key` that no
+        other session waits for.
+        """
+        queue = self._queues.get(session_id)
+        if not queue:
+            return
+
+        kept = deque()
+        for request in queue:
+            queued_key = request[0]
+            subscribers = self._subscribers[queued_key]
+            if queued_key != key:
+                subscribers.discard(session_id)
+            if subscribers:
+                kept.append(request)
+            else:
+                del self._subscribers[queued_key]
+                self._pending.pop(queued_key).cancel()
+                self.replaced += 1
+
+        if kept:
+            self._queues[session_id] = kept
+        else:
+            del self._queues[session_id]
+
+    def _dispatch(self):
+        """
+        Sends queued requests to the free workers, taking one request per
+        session in turn. A request goes to the worker of the previous request
+        of its session if it is free.
+        """
+        with self._lock:
+            while not all(self._busy) and self._queues:
+                session_id, queue = self._queues.popitem(last=False)
+                key, fn, args = queue.popleft()
+                if queue:
+                    self._queues[session_id] = queue
+
+                worker = self._affinity.get(session_id)
+                if worker is None or self._busy[worker]:
+                    worker = self._busy.index(False)
+
+                try:
+                    try:
+                        worker_future = self._workers[worker].submit(fn,
+                                                                     *args)
+                    except BrokenProcessPool:
+                        # The process died since its last request
+                        self._replace_worker(worker)
+                        worker_future = self._workers[worker].submit(fn,
+                                                                     *args)
+                except RuntimeError as exception:
+                    # The pool was shut down or a worker died
+                    self._subscribers.pop(key)
+                    self._pending.pop(key).set_exception(exception)
+                    continue
+
+                self._busy[worker] = True
+                self._affinity[session_id] = worker
+                worker_future.add_done_callback(
+                                functools.partial(self._done, key, worker))
+
+    def _replace_worker(self, worker:int):
+        """
+        Replaces a broken worker pool with a new one. The sessions of the
+        worker lose their affinity, its caches died with the process.
+        """
+        self._workers[worker].shutdown(wait=False)
+        self._workers[worker] = ProcessPoolExecutor(1)
+        self._affinity = {session_id: affinity for session_id, affinity in
+                          self._affinity.items() if affinity != worker}
+
+    def _done(self, key:Hashable, worker:int, worker_future:Future):
+
+        with self._lock:
+            self._busy[worker] = False
+            if not worker_future.cancelled() and \
+                    isinstance(worker_future.exception(), BrokenProcessPool):
+                self._replace_worker(worker)
+            self._subscribers.pop(key)
+            future = self._pending.pop(key)
+            self._dispatch()
+
+        if future.cancelled():
+            return
+        if worker_future.cancelled():
+            future.cancel()
+            return
+        exception = worker_future.exception()
+        if exception is None:
+            future.set_result(worker_future.result())
+        else:
+            future.set_exception(exception)
+
+    def shutdown(self, wait:bool = True):
+        """
+        Cancels the queued requests and stops the worker processes.
+        """
+        with self._lock:
+            queued = [key for queue in self._queues.values()
+                      for key, _, _ in queue]
+            self._queues.clear()
+            for key in queued:
+                self._subscribers.pop(key)
+                self._pending.pop(key).cancel()
+        for executor in self._workers:
+            executor.shutdown(wait=wait)
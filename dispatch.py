@@ -0,0 +1,186 @@
+import numpy as np
+from typing import *
+
+# Price-responsive dispatch.
+# A merchant electrolyser only runs in the hours where the electricity is
+# cheap enough. For every year of an hourly price series, the hours are
+# sorted by price and the margin of running the k cheapest hours is computed
+# for every k with a cumulative sum, so the optimal operating price threshold
+# comes from a single vectorized sweep per year.
+
+
+def load_price_series(path:str, hours_per_year:int = 8760) -> np.ndarray:
+    """
+    Loads an hourly electricity price series (USD/kWh) as a memory-mapped
+    (years, hours) array.
+
+    Arguments:
+    ---------
+    path: str -> .npy file with a (years, hours) or flat array, or a raw
+        float64 binary file
+
+    hours_per_year: int -> Hours of every year of a flat series
+
+    Returns:
+    -------
+    np.ndarray -> Memory-mapped (years, hours) prices
+    """
+    if path.endswith(".npy"):
+        prices = np.load(path, mmap_mode="r")
+    else:
+        prices = np.memmap(path, dtype=np.float64, mode="r")
+    return yearly_prices(prices, hours_per_year)
+
+
+def yearly_prices(prices:np.ndarray, hours_per_year:int = 8760) -> np.ndarray:
+    """
+    Checks an hourly price series and shapes it as a (years, hours) array.
+
+    Arguments:
+    ---------
+    prices: np.ndarray -> (years, hours) or flat hourly prices
+
+    hours_per_year: int -> Hours of every year of a flat series
+
+    Returns:
+    -------
+    np.ndarray -> (years, hours) prices, a view of the series
+    """
+    if prices.ndim == 1:
+        if not prices.size or prices.size % hours_per_year:
+            raise ValueError("The series length ({}) is not a whole number "
+                             "of years".format(prices.size))
+        prices = prices.reshape(-1, hours_per_year)
+    elif prices.ndim != 2 or not prices.size:
+        raise ValueError("The series must be a flat or a (years, hours) "
+                         "array, not {}".format(prices.shape))
+    return prices
+
+
+def optimal_dispatch(prices:np.ndarray,
+                     energy_value:float,
+                     min_rate_of_use:float = 0.0,
+                     max_rate_of_use:float = 1.0) -> dict:
+    """
+    Finds the operating price threshold that maximizes the yearly margin.
+
+    Arguments:
+    ---------
+    prices: np.ndarray -> Hourly electricity prices of one year (USD/kWh)
+
+    energy_value: float -> Value of the hydrogen produced with one kWh, net
+        of the water cost (USD/kWh)
+
+    min_rate_of_use, max_rate_of_use: float -> Bounds of the fraction of the
+        hours the electrolyser runs
+
+    Returns:
+    -------
+    dict -> "threshold" price (the electrolyser runs when the price is lower
+        or equal), "rate of use", average "energy cost" of the energy used
+        (USD/kWh) and "margin" per kW of capacity (USD/kW/year)
+    """
+    sorted_prices = np.sort(np.asarray(prices, dtype=float))
+    hours = sorted_prices.size
+    cumulative_cost = np.concatenate([[0.0], np.cumsum(sorted_prices)])
+
+    # Margin of running the k cheapest hours, for every k in the bounds
+    low = int(np.ceil(min_rate_of_use * hours))
+    high = int(np.floor(max_rate_of_use * hours))
+    k = np.arange(low, high + 1)
+    margin = k * energy_value - cumulative_cost[low:high + 1]
+
+    best = low + int(np.argmax(margin))
+
+    return {"threshold": sorted_prices[best - 1] if best else -np.inf,
+            "rate of use": best / hours,
+            "energy cost": cumulative_cost[best] / best if best else np.nan,
+            "margin": margin[best - low]}
+
+
+def dispatch_schedule(prices:np.ndarray,
+                      years:np.ndarray,
+                      efficiency:Union[float, np.ndarray],
+                      hydrogen_price:Callable,
+                      water_price:Callable,
+                      min_rate_of_use:float = 0.0,
+                      max_rate_of_use:float = 1.0) -> dict:
+    """
+    Optimal dispatch of every year of an hourly price series.
+
+    Arguments:
+    ---------
+    prices: np.ndarray -> (years, hours) electricity prices (USD/kWh), may be
+        memory-mapped, only one year is loaded at a time
+
+    years: np.ndarray -> Year of every row of the prices
+
+    efficiency: float or array -> Efficiency of the electrolyser by year
+        [kWh/KgH2]
+
+    hydrogen_price, water_price: Callable -> Price curves by year
+
+    min_rate_of_use, max_rate_of_use: float -> Bounds of the rate of use
+
+    Returns:
+    -------
+    dict -> Arrays by year of the `optimal_dispatch` results, and "years"
+    """
+    years = np.asarray(years)
+    efficiency = np.broadcast_to(np.asarray(efficiency, dtype=float),
+                                 years.shape)
+    # Value of the hydrogen produced by one kWh, net of the water cost
+    energy_value = (np.asarray(hydrogen_price(years)) - \
+                    9*np.asarray(water_price(years))/997) / efficiency
+
+    results = {name: np.empty(len(years)) for name in
+               ("threshold", "rate of use", "energy cost", "margin")}
+    for i in range(len(years)):
+        year_results = optimal_dispatch(prices[i],
+                                        energy_value[i],
+                                        min_rate_of_use,
+                                        max_rate_of_use)
+        for name, value in year_results.items():
+            results[name][i] = value
+
+    results["years"] = years
+    return results
+
+
+def dispatch_inputs(schedule:dict, prices:np.ndarray
+                    ) -> Tuple[float, Tuple[list, list, str]]:
+    """
+    Converts a dispatch schedule to the inputs of the profitability model:
+    the average rate of use and the control points of the energy cost curve.
+
+    The model runs every year at the average rate of use, so the energy cost
+    of a year is the average price of its cheapest hours at that rate, also
+    in the years where the optimal dispatch would not run. The years outside
+    the series get the average cost of the series, not the cost of its first
+    or last year.
+
+    Arguments:
+    ---------
+    schedule: dict -> Output of `dispatch_schedule`
+
+    prices: np.ndarray -> (years, hours) electricity prices of the schedule
+
+    Returns:
+    -------
+    tuple -> rate_of_use, (years, energy costs, interpolation kind)
+    """
+    years = [int(year) for year in schedule["years"]]
+    rate_of_use = float(np.mean(schedule["rate of use"]))
+
+    hours = max(int(round(rate_of_use * prices.shape[-1])), 1)
+    energy_cost = [float(np.mean(np.partition(np.asarray(prices[i],
+                                                         dtype=float),
+                                              hours - 1)[:hours]))
+                   for i in range(len(years))]
+    average_cost = float(np.mean(energy_cost))
+
+    # "nearest" between the years of the series and one year on each side
+    # at the average cost
+    return rate_of_use, ([years[0] - 1] + years + [years[-1] + 1],
+                         [average_cost] + energy_cost + [average_cost],
+                         "nearest")
@@ -4,14 +4,101 @@ import streamlit as st
 import numpy as np
 from scipy import interpolate
 import plotly.graph_objects as go
-from functions import calculate_profitability_V2, calculate_profitability_V3,\
-                     triangular_dist_density
+from functions import triangular_dist_density
+from streaming_stats import SimulationSummary, SIMULATION_METRICS,\
+                           SUMMARY_COLUMNS
+from pipeline import run_simulation
+from compute_service import ComputeService, ServiceBusy, request_key
+from sensitivity import sensitivity_report, SENSITIVITY_COLUMNS
+from dispatch import dispatch_schedule, dispatch_inputs, yearly_prices
+from grid_sweep import grid_sweep, sample_inputs, sweep_heatmap, SWEEP_INPUTS
+from site_screening import load_sites, screen_sites, shortlist
+from variance_reduction import ESTIMATORS, ESTIMATE_COLUMNS
+from surrogate import load_surrogate, train_surrogate, price_level
 import json
-import plotly.express as px
+import uuid
+import time
+import threading
 
 with open('electrolyser_params.json') as json_file:
     IRENA_data = json.load(json_file)
 
+# Default ranges of the parameter sweep, the other inputs are swept from 50%
+# to 150% of their current value
+SWEEP_RANGES = {"rate_of_use": (0.1, 1.0),
+                "E_o": (10000.0, 100000.0),
+                "discount_rate": (0.0, 0.15),
+                "efficiency_reduction_rate": (0.0, 0.05),
+                "E_cost_scale": (0.5, 2.0),
+                "hydrogen_price_scale": (0.5, 2.0),
+                "water_price_scale": (0.5, 2.0)}
+
+
+# Compute service shared by all the sessions of the server, created by the
+# first session
+_compute_service = None
+_compute_service_lock = threading.Lock()
+
+
+def get_compute_service():
+    """
+    Compute service shared by all the sessions of the server.
+    """
+    global _compute_service
+    with _compute_service_lock:
+        if _compute_service is None:
+            _compute_service = ComputeService()
+        return _compute_service
+
+
+# Surrogates by electrolyser type and their background trainings in the
+# compute service, shared by all the sessions of the server
+_surrogates = {}
+_surrogate_trainings = {}
+_surrogate_lock = threading.Lock()
+
+
+def get_surrogate(electrolyser_type, base_prices, service):
+    """
+    Surrogate of the electrolyser type for the current parameter file, None
+    while it is not available. A missing surrogate is trained in the
+    background by the compute service and saved when the training ends.
+    """
+    with _surrogate_lock:
+        if electrolyser_type in _surrogates:
+            return _surrogates[electrolyser_type]
+
+        training = _surrogate_trainings.get(electrolyser_type)
+        if training is None:
+            surrogate = load_surrogate(electrolyser_type, base_prices)
+            if surrogate is None:
+                try:
+                    _surrogate_trainings[electrolyser_type] = service.submit(
+                            ("surrogate training", electrolyser_type),
+                            ("surrogate", electrolyser_type,
+                             request_key(base_prices)),
+                            train_surrogate,
+                            electrolyser_type,
+                            base_prices)
+                except ServiceBusy:
+                    pass
+                return None
+        elif training.cancelled():
+            # Trained again on the next run
+            del _surrogate_trainings[electrolyser_type]
+            return None
+        elif not training.done() or training.exception() is not None:
+            # A failed training is not retried, the Monte Carlo simulation
+            # is always run
+            return None
+        else:
+            surrogate = training.result()
+            surrogate.save()
+
+        _surrogates[electrolyser_type] = surrogate
+        return surrogate
+
+
 def display_selector():
 
    
@@ -52,6 +139,11 @@ def display_selector():
                                 max_value=10000,
                                 step = 1,
                                 format="%d")
+
+    # Variance reduction of the mean ROI, NPV and hydrogen cost
+    estimator = col2.selectbox("Monte Carlo estimator", ESTIMATORS,
+                               index=ESTIMATORS.index(
+                                            "antithetic control variates"))
         
 
     # Now we make several containers for energy production cost, hydorgen price
@@ -74,6 +166,7 @@ def display_selector():
         energy_cost_func = interpolate.interp1d(years, energy_production_costs, 
                                             kind=interpolation_type,
                                             fill_value="extrapolate")
+        energy_cost_points = (years, tuple(energy_production_costs), interpolation_type)
         years_plot = np.arange(2022, 2061, 1)
         energy_production_costs_plot= energy_cost_func(years_plot)
             
@@ -108,6 +201,7 @@ def display_selector():
         hydrogen_price_func = interpolate.interp1d(years, hydrogen_prices, 
                                         kind=interpolation_type,
                                         fill_value="extrapolate")
+        hydrogen_price_points = (years, tuple(hydrogen_prices), interpolation_type)
         
         years_plot = np.arange(2022, 2061, 1)
         
@@ -148,6 +242,7 @@ def display_selector():
         water_price_func = interpolate.interp1d(years, water_prices, 
                                             kind=interpolation_type,
                                             fill_value="extrapolate")
+        water_price_points = (years, tuple(water_prices), interpolation_type)
         
         years_plot = np.arange(2022, 2061, 1)
         
@@ -318,112 +413,548 @@ def display_selector():
        
     #--------------------------------------------------------------------------#
     
-    ROI_arr = np.zeros(montecarlo_iters)
-    IRR_arr = np.zeros(montecarlo_iters)
-    RT_arr = np.zeros(montecarlo_iters)
-    H2_COST_arr = np.zeros(montecarlo_iters)
-
-    efficiency_arr = np.zeros(montecarlo_iters)
-    CAPEX_arr = np.zeros(montecarlo_iters)
-    lifetime_years_arr = np.zeros(montecarlo_iters)
-    for i in range(montecarlo_iters):
-        efficiency = np.random.triangular(electrolyser_efficiency_left, 
-                                          electrolyser_efficiency_mode,
-                                          electrolyser_efficiency_right
-                                          )
-        lifetime = np.random.triangular(electrolyser_lifetime_left,
-                                        electrolyser_lifetime_mode,
-                                        electrolyser_lifetime_right)
-        
-        capital_cost = np.random.triangular(electrolyser_capital_cost_left,
-                                            electrolyser_capital_cost_mode,
-                                            electrolyser_capital_cost_right)
-        
-        # Return on Investment
-        # Internal rate of return
-        # Return Time 
-        # Are calculated
-        ROI, IRR, RT, H2_COST = calculate_profitability_V3( 
-                                                        efficiency,
-                                                        eff_reduction_rate,
-                                                        capital_cost,
-                                                        lifetime,
-                                                        power_output,
-                                                        electrolyser_type,
-                                                        rate_of_use,
-                                                        disscount_rate,
-                                                        energy_cost_func,
-                                                        hydrogen_price_func,
-                                                        water_price_func
-                                                        )
-
-        ROI_arr[i]     = ROI
-        IRR_arr[i]     = IRR
-        RT_arr[i]      = RT
-        H2_COST_arr[i] = H2_COST
-        
-        efficiency_arr[i] = efficiency
-        CAPEX_arr[i] = capital_cost
-        lifetime_years_arr[i] = int(np.floor(lifetime * 1000 /(rate_of_use * 24 *365)))
+    # Price-responsive dispatch: with an hourly price series the electrolyser
+    # only runs when the electricity is cheap enough, which sets the rate of
+    # use and the energy cost of the simulation.
+    with st.expander("Price-responsive dispatch"):
+        col_a, col_b = st.columns([1, 3])
+        price_file = col_a.file_uploader("Hourly electricity prices [USD/kWh] "
+                                         "(.npy, one row per year)",
+                                         type=["npy"])
+        first_year = col_a.number_input("First year of the series",
+                                        value=2023, min_value=2022,
+                                        max_value=2060, step=1, format="%d")
+        max_dispatch_rate = col_a.slider("Maximum rate of use",
+                                         min_value=0.01, max_value=1.0,
+                                         value=1.0, step=0.01)
+        if price_file is not None:
+            try:
+                hourly_prices = yearly_prices(np.load(price_file))
+            except ValueError as error:
+                col_a.error("Invalid price series: {}".format(error))
+                st.stop()
+
+            dispatch = dispatch_schedule(hourly_prices,
+                                first_year + np.arange(len(hourly_prices)),
+                                electrolyser_efficiency_mode,
+                                hydrogen_price_func,
+                                water_price_func,
+                                max_rate_of_use=max_dispatch_rate)
+            rate_of_use, energy_cost_points = dispatch_inputs(dispatch,
+                                                             hourly_prices)
+            if rate_of_use == 0:
+                col_a.warning("No hour of the price series is profitable, "
+                              "the electrolyser would never run. The "
+                              "simulation is skipped.")
+                st.stop()
+            energy_cost_func = interpolate.interp1d(*energy_cost_points[:2],
+                                            kind=energy_cost_points[2],
+                                            fill_value="extrapolate")
+
+            col_a.text("Average rate of use: {0:.1f} %".format(rate_of_use*100))
+
+            chart = go.Figure()
+            chart.add_trace(go.Scatter(x=dispatch["years"],
+                                       y=dispatch["rate of use"]*100,
+                                       mode='lines+markers',
+                                       name='rate of use [%]'))
+            chart.add_trace(go.Scatter(x=dispatch["years"],
+                                       y=dispatch["energy cost"],
+                                       mode='lines+markers',
+                                       name='energy cost [USD/kWh]',
+                                       yaxis='y2'))
+            chart.update_layout(title='Optimal dispatch',
+                                xaxis_title='Years',
+                                yaxis_title='Rate of use [%]',
+                                yaxis2=dict(title='USD/kWh',
+                                            overlaying='y',
+                                            side='right'))
+            col_b.plotly_chart(chart, use_container_width=True)
+
+    # The simulations of all the sessions run in the shared compute service,
+    # identical studies launched by several users are computed once.
+    service = get_compute_service()
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
+    distributions = {"efficiency": (electrolyser_efficiency_left,
+                                    electrolyser_efficiency_mode,
+                                    electrolyser_efficiency_right),
+                     "lifetime": (electrolyser_lifetime_left,
+                                  electrolyser_lifetime_mode,
+                                  electrolyser_lifetime_right),
+                     "CAPEX_sys": (electrolyser_capital_cost_left,
+                                   electrolyser_capital_cost_mode,
+                                   electrolyser_capital_cost_right)}
+    # The min, mode and max sliders are independent
+    unsorted = [name for name, (left, mode, right) in distributions.items()
+                if not left <= mode <= right]
+    if unsorted:
+        st.warning("The minimum, mode and maximum must be in increasing "
+                   "order ({}). The simulation is skipped."
+                   .format(", ".join(unsorted)))
+        st.stop()
+
+    request = {"n": montecarlo_iters,
+               "distributions": distributions,
+               "efficiency_reduction_rate": eff_reduction_rate,
+               "E_o": power_output,
+               "electrolyser_type": electrolyser_type,
+               "rate_of_use": rate_of_use,
+               "discount_rate": disscount_rate,
+               "E_cost": energy_cost_points,
+               "hydrogen_price": hydrogen_price_points,
+               "water_price": water_price_points,
+               "gradients": True,
+               "estimator": estimator}
+
+    # The surrogate answers at once, and is reconciled with the Monte Carlo
+    # simulation when it ends
+    base_prices = {"E_cost": (years, projected_energy_cost, "linear"),
+                   "hydrogen_price": (years, projected_hydrogen_price,
+                                      "linear"),
+                   "water_price": (years, projected_water_price, "linear")}
+    surrogate_inputs = {
+            "E_o": power_output,
+            "rate_of_use": rate_of_use,
+            "discount_rate": disscount_rate,
+            "efficiency_reduction_rate": eff_reduction_rate,
+            "efficiency_left": electrolyser_efficiency_left,
+            "efficiency_mode": electrolyser_efficiency_mode,
+            "efficiency_right": electrolyser_efficiency_right,
+            "lifetime_left": electrolyser_lifetime_left,
+            "lifetime_mode": electrolyser_lifetime_mode,
+            "lifetime_right": electrolyser_lifetime_right,
+            "capital_cost_left": electrolyser_capital_cost_left/power_output,
+            "capital_cost_mode": electrolyser_capital_cost_mode/power_output,
+            "capital_cost_right": electrolyser_capital_cost_right/power_output,
+            "E_cost_level": price_level(energy_cost_points,
+                                        base_prices["E_cost"]),
+            "hydrogen_price_level": price_level(hydrogen_price_points,
+                                                base_prices["hydrogen_price"]),
+            "water_price_level": price_level(water_price_points,
+                                             base_prices["water_price"])}
+
+    surrogate_display = st.empty()
+    surrogate = get_surrogate(electrolyser_type, base_prices, service)
+    prediction = None
+    if surrogate is None:
+        surrogate_display.caption("The surrogate model is being trained in "
+                                  "the background, the results come from "
+                                  "the Monte Carlo simulation.")
+    elif not surrogate.in_domain(surrogate_inputs):
+        surrogate_display.caption("The inputs are outside the training range "
+                                  "of the surrogate model, the results come "
+                                  "from the Monte Carlo simulation.")
+    else:
+        start = time.perf_counter()
+        prediction = surrogate.predict(surrogate_inputs)
+        elapsed = time.perf_counter() - start
+        surrogate_display.dataframe(
+                [{"output": output,
+                  "surrogate ({:.2f} ms)".format(elapsed*1000): values[0]}
+                 for output, values in prediction.items()])
+
+    # Return on Investment
+    # Internal rate of return
+    # Return Time 
+    # Are calculated
+    try:
+        future = service.submit(st.session_state.session_id,
+                                request_key(request),
+                                run_simulation,
+                                request,
+                                st.session_state.session_id)
+    except ServiceBusy:
+        st.warning("The server is busy ({} simulations queued), please try "
+                   "again in a moment.".format(service.queue_depth))
+        st.stop()
+
+    st.caption("Server load: {} simulations running on {} workers, {} "
+               "queued".format(service.running, service.max_workers,
+                               service.queue_depth))
+    with st.spinner("Running the Monte Carlo simulation"):
+        results = future.result()
+
+    # Only streaming summaries of the results are used for the display. The
+    # antithetic samples are bootstrapped by pairs.
+    summary = SimulationSummary(SIMULATION_METRICS + ("efficiency",
+                                                      "CAPEX",
+                                                      "lifetime years"),
+                                paired=estimator.startswith("antithetic"))
+    summary.update({"ROI": results["ROI"],
+                    "IRR": results["IRR"]*100,
+                    "NPV": results["NPV"],
+                    "H2 cost": results["LCOH"],
+                    "payback": results["payback"],
+                    "efficiency": results["efficiency"],
+                    "CAPEX": results["CAPEX_sys"],
+                    "lifetime years": results["lifetime years"]})
+
+    # Reconciliation of the surrogate with the Monte Carlo simulation
+    if prediction is not None:
+        rows = []
+        for (output, values), errors in zip(prediction.items(),
+                                            surrogate.error_report):
+            metric, quantile = output.rsplit(" P", 1)
+            monte_carlo = summary[metric].quantile(float(quantile)/100)
+            rows.append({"output": output,
+                         "surrogate": values[0],
+                         "Monte Carlo": monte_carlo,
+                         "difference": values[0] - monte_carlo,
+                         "held-out RMSE": errors[0]})
+        surrogate_display.dataframe(rows)
     
     #--------------------------------------------------------------------------#
 
     col_a, col_b = st.columns([1.2,3])
     col_b.subheader("Empirical cumulative distributions")
-    ROI_ecdf = px.ecdf(x = ROI_arr)
 
-    ROI_ecdf.update_layout(title='Return on Investment',
-                            xaxis_title='ROI [%]',  
+    def ecdf_chart(metric, title, xaxis_title):
+        x, y = summary[metric].ecdf()
+        chart = go.Figure()
+        chart.add_trace(go.Scatter(x=x, y=y, line_shape='hv', mode='lines'))
+        chart.update_layout(title=title,
+                            xaxis_title=xaxis_title,
                             yaxis_title='Percentile')
+        col_b.plotly_chart(chart, use_container_width=True)
 
-    col_b.plotly_chart(ROI_ecdf, use_container_width=True)
-
-    IRR_ecdf = px.ecdf(x = IRR_arr*100)
-
-    IRR_ecdf.update_layout(title='Internal Rate of Return',
-                            xaxis_title='IRR [%]',
-                            yaxis_title='Percentile')
-    col_b.plotly_chart(IRR_ecdf, use_container_width=True)
+    ecdf_chart("ROI", 'Return on Investment', 'ROI [%]')
 
-    H2_COST_ecdf = px.ecdf(x = H2_COST_arr)
+    ecdf_chart("IRR", 'Internal Rate of Return', 'IRR [%]')
 
-    H2_COST_ecdf.update_layout(title='Hydrogen Cost',
-                            xaxis_title='Hydrogen Cost [USD/kg]',
-                            yaxis_title='Percentile')
-    
-    col_b.plotly_chart(H2_COST_ecdf, use_container_width=True)
+    ecdf_chart("H2 cost", 'Hydrogen Cost', 'Hydrogen Cost [USD/kg]')
 
     
 
     #--------------------------------------------------------------------------#
-    ROI_mean = ROI_arr.mean()
-    IRR_mean = np.mean(IRR_arr[~np.isnan(IRR_arr)])*100
-    H2_COST_mean = H2_COST_arr.mean()
-    lifetime_years_mean = lifetime_years_arr.mean()
-    efficiency_mean = efficiency_arr.mean()
-    CAPEX_mean = CAPEX_arr.mean()
-    
-    total_return = ROI_mean/100 * CAPEX_mean
+    # The Monte Carlo error of every figure is shown as a 95% bootstrap
+    # confidence interval
+    ROI_mean = summary["ROI"].mean
+    IRR_mean = summary["IRR"].mean
+    NPV_mean = summary["NPV"].mean
+    H2_COST_mean = summary["H2 cost"].mean
+    payback_median = summary["payback"].median
+    lifetime_years_mean = summary["lifetime years"].mean
+    efficiency_mean = summary["efficiency"].mean
+
+    ROI_ci = summary["ROI"].mean_ci()
+    IRR_ci = summary["IRR"].mean_ci()
+    NPV_ci = np.array(summary["NPV"].mean_ci())
+    H2_COST_ci = summary["H2 cost"].mean_ci()
+
+    # The variance reduced estimators replace the sample means, with normal
+    # confidence intervals from their standard errors
+    estimates = results["estimates"]
+    if estimator != "plain":
+        def normal_ci(metric):
+            estimate = estimates[metric]
+            return np.array([estimate["mean"] - 1.96*estimate["standard error"],
+                             estimate["mean"] + 1.96*estimate["standard error"]])
+        ROI_mean, ROI_ci = estimates["ROI"]["mean"], normal_ci("ROI")
+        NPV_mean, NPV_ci = estimates["NPV"]["mean"], normal_ci("NPV")
+        H2_COST_mean, H2_COST_ci = estimates["LCOH"]["mean"], normal_ci("LCOH")
+    payback_ci = np.array(summary["payback"].quantile_ci(0.5))
+    lifetime_years_ci = summary["lifetime years"].mean_ci()
+    # The flow rates decrease with the efficiency
+    efficiency_ci = np.array(summary["efficiency"].mean_ci())[::-1]
+    
     water_flow_rate  = power_output*9/(efficiency_mean * 997) 
     hydrogen_flow_rate = power_output/(efficiency_mean * 0.08375) 
     hydrogen_mass_rate = power_output/efficiency_mean*24*rate_of_use
+    water_flow_rate_ci = power_output*9/(efficiency_ci * 997)
+    hydrogen_flow_rate_ci = power_output/(efficiency_ci * 0.08375)
+    hydrogen_mass_rate_ci = power_output/efficiency_ci*24*rate_of_use
+
+    ci = " (95% CI {0:.2f} - {1:.2f})".format
     
     # Display the results
     col_a.subheader("Results for the average case")
     col_a.text("Capital costs: {0:.2f}M $".format(electrolyser_capital_cost_mode*10**(-6)))
-    col_a.text("Net present value: {0:.2f}M $".format(total_return*10**(-6)))
-    col_a.text("Return On Invesment:  {0:.2f} % ".format(ROI_mean))
-    col_a.text("Water flow rate: {0:.2f} [m3/s]".format(water_flow_rate))
-    col_a.text("Hydrogen flow rate: {0:.2f} [m3/s]".format(hydrogen_flow_rate))
-    col_a.text("Daily Hydrogen production: {0:.2f} [kg/24h]".format(hydrogen_mass_rate))
-    col_a.text("Internal Rate of Return : {0:.2f} % ".format(IRR_mean))
-    col_a.text("Hydrogen cost: {0:.2f} [USD/kg]".format(H2_COST_mean))
-    col_a.text("Lifetime: {} years".format(lifetime_years_mean))
-    col_a.text("Payback Year : {} ".format(np.median(RT_arr)))
-    col_a.write("Payback Time :  {:.2f} years ".format(np.median(RT_arr) -2022) )
+    col_a.text("Net present value: {0:.2f}M $".format(NPV_mean*10**(-6)) + \
+               ci(*NPV_ci*10**(-6)))
+    col_a.text("Return On Invesment:  {0:.2f} % ".format(ROI_mean) + ci(*ROI_ci))
+    col_a.text("Water flow rate: {0:.2f} [m3/s]".format(water_flow_rate) + \
+               ci(*water_flow_rate_ci))
+    col_a.text("Hydrogen flow rate: {0:.2f} [m3/s]".format(hydrogen_flow_rate) + \
+               ci(*hydrogen_flow_rate_ci))
+    col_a.text("Daily Hydrogen production: {0:.2f} [kg/24h]".format(hydrogen_mass_rate) + \
+               ci(*hydrogen_mass_rate_ci))
+    col_a.text("Internal Rate of Return : {0:.2f} % ".format(IRR_mean) + ci(*IRR_ci))
+    col_a.text("Hydrogen cost: {0:.2f} [USD/kg]".format(H2_COST_mean) + \
+               ci(*H2_COST_ci))
+    col_a.text("Lifetime: {} years".format(lifetime_years_mean) + \
+               ci(*lifetime_years_ci))
+    col_a.text("Payback Year : {} ".format(payback_median) + ci(*payback_ci))
+    col_a.write("Payback Time :  {:.2f} years ".format(payback_median -2022) + \
+                ci(*payback_ci - 2022))
+
+    if estimator != "plain":
+        col_a.caption("Estimator: {}, variance reduction of the means"
+                      .format(estimator))
+        col_a.dataframe([dict(zip(ESTIMATE_COLUMNS,
+                                  ("H2 cost" if metric == "LCOH" else metric,
+                                   estimate["mean"],
+                                   estimate["standard error"],
+                                   estimate["variance reduction"],
+                                   estimate["equivalent samples"])))
+                         for metric, estimate in estimates.items()])
+
+    # Export of the summary statistics with their confidence intervals. The
+    # means and intervals are the displayed ones, so the variance reduced
+    # estimates replace the bootstrap of the ROI, NPV and H2 cost.
+    export_rows = []
+    for row in summary.table():
+        metric = "LCOH" if row[0] == "H2 cost" else row[0]
+        if estimator != "plain" and metric in estimates:
+            estimate = estimates[metric]
+            export_rows.append((*row[:2], estimate["mean"],
+                                *normal_ci(metric), *row[5:], estimator,
+                                estimate["standard error"],
+                                estimate["variance reduction"]))
+        else:
+            export_rows.append((*row, "bootstrap",
+                                summary[row[0]].moments.standard_error, ""))
+    summary_csv = "\n".join([",".join(SUMMARY_COLUMNS + \
+                                      ("estimator", "standard error",
+                                       "variance reduction"))] + \
+                            [",".join(str(value) for value in row)
+                             for row in export_rows])
+    col_a.download_button("Download summary (CSV)",
+                          summary_csv,
+                          file_name="electrolyser_summary.csv",
+                          mime="text/csv")
 
     
     
 
 
 
+
+    #--------------------------------------------------------------------------#
+
+    # Local sensitivity from the analytic gradients of every sample
+    with st.expander("Local sensitivity"):
+        col_a, col_b = st.columns([1, 3])
+        sensitivity_metric = col_a.selectbox("Metric ",
+                                ["NPV", "ROI", "LCOH"],
+                                format_func={"NPV": "Net present value",
+                                             "ROI": "Return on investment",
+                                             "LCOH": "Hydrogen cost"}.get)
+        sample_inputs_values = {"efficiency": results["efficiency"],
+                                "efficiency_reduction_rate": eff_reduction_rate,
+                                "CAPEX_sys": results["CAPEX_sys"],
+                                "lifetime": results["lifetime"],
+                                "E_o": power_output,
+                                "rate_of_use": rate_of_use,
+                                "discount_rate": disscount_rate,
+                                "E_cost_scale": 1.0,
+                                "hydrogen_price_scale": 1.0,
+                                "water_price_scale": 1.0}
+        report = sensitivity_report(
+                        results["gradients"][sensitivity_metric],
+                        sample_inputs_values,
+                        results[sensitivity_metric])
+
+        col_a.caption("Elasticity: % change of the metric per 1 % change "
+                      "of the input")
+        col_a.dataframe([dict(zip(SENSITIVITY_COLUMNS, row))
+                         for row in report])
+
+        chart = go.Figure()
+        chart.add_trace(go.Box(
+                    y=[row[0] for row in report],
+                    q1=[row[3] for row in report],
+                    median=[row[4] for row in report],
+                    q3=[row[5] for row in report],
+                    lowerfence=[row[3] for row in report],
+                    upperfence=[row[5] for row in report],
+                    mean=[row[2] for row in report],
+                    orientation='h'))
+        chart.update_layout(title='Elasticity distributions (P10 - P90)',
+                            xaxis_title='Elasticity',
+                            yaxis_title='Input')
+        col_b.plotly_chart(chart, use_container_width=True)
+
+    #--------------------------------------------------------------------------#
+
+    # The triangular distributions of the capital cost are given per kW so the
+    # sweep can also change the plant size
+    base_inputs = {"efficiency": electrolyser_efficiency_mode,
+                   "efficiency_reduction_rate": eff_reduction_rate,
+                   "capital_cost": electrolyser_capital_cost_mode/power_output,
+                   "lifetime": electrolyser_lifetime_mode,
+                   "E_o": power_output,
+                   "rate_of_use": rate_of_use,
+                   "discount_rate": disscount_rate}
+    distributions = {"efficiency": (electrolyser_efficiency_left,
+                                    electrolyser_efficiency_mode,
+                                    electrolyser_efficiency_right),
+                     "lifetime": (electrolyser_lifetime_left,
+                                  electrolyser_lifetime_mode,
+                                  electrolyser_lifetime_right),
+                     "capital_cost": (electrolyser_capital_cost_left/power_output,
+                                      electrolyser_capital_cost_mode/power_output,
+                                      electrolyser_capital_cost_right/power_output)}
+
+    display_grid_sweep(electrolyser_type,
+                       base_inputs,
+                       distributions,
+                       energy_cost_func,
+                       hydrogen_price_func,
+                       water_price_func)
+
+    display_site_screening(electrolyser_type,
+                           base_inputs,
+                           energy_cost_func,
+                           hydrogen_price_func,
+                           water_price_func)
+
+
+def display_grid_sweep(electrolyser_type,
+                       base_inputs,
+                       distributions,
+                       energy_cost_func,
+                       hydrogen_price_func,
+                       water_price_func):
+    """
+    Displays the two-dimensional parameter sweep of the profitability model.
+    """
+
+    with st.expander("Parameter sweep"):
+        col_a, col_b = st.columns([1, 3])
+
+        inputs = list(SWEEP_INPUTS)
+        axes = {}
+        for axis, default in (("X", "rate_of_use"), ("Y", "E_o")):
+            name = col_a.selectbox("{} axis".format(axis),
+                                   inputs,
+                                   index=inputs.index(default),
+                                   format_func=SWEEP_INPUTS.get)
+            base = base_inputs.get(name, 1.0)
+            low = col_a.number_input("{} axis min".format(axis),
+                                     value=float(SWEEP_RANGES.get(name,
+                                                        (0.5*base, 1.5*base))[0]),
+                                     format="%0.4f")
+            high = col_a.number_input("{} axis max".format(axis),
+                                      value=float(SWEEP_RANGES.get(name,
+                                                        (0.5*base, 1.5*base))[1]),
+                                      format="%0.4f")
+            axes[name] = (low, high)
+
+        if len(axes) < 2:
+            col_a.warning("Select two different inputs to sweep")
+            return
+
+        grid_size = col_a.slider("Grid points per axis",
+                                 min_value=5, max_value=100, value=50)
+        samples_per_cell = col_a.number_input("Monte Carlo samples per cell "
+                                              "(0 for the mode values)",
+                                              value=0, min_value=0,
+                                              max_value=1000, step=1,
+                                              format="%d")
+        metric = col_a.selectbox("Metric", ["NPV", "ROI", "LCOH"],
+                                 format_func={"NPV": "Net present value [USD]",
+                                              "ROI": "Return on investment [%]",
+                                              "LCOH": "Hydrogen cost [USD/kg]"
+                                              }.get)
+        stat = col_a.selectbox("Statistic", ["mean", "P10", "P90"])
+
+        if not col_a.button("Run sweep"):
+            return
+
+        axes = {name: np.linspace(low, high, grid_size)
+                for name, (low, high) in axes.items()}
+        samples = sample_inputs(samples_per_cell, distributions) \
+                  if samples_per_cell else None
+
+        results = grid_sweep(electrolyser_type,
+                             base_inputs,
+                             axes,
+                             energy_cost_func,
+                             hydrogen_price_func,
+                             water_price_func,
+                             samples=samples,
+                             metrics=(metric,))
+
+        (x_name, x_values), (y_name, y_values) = axes.items()
+        col_b.plotly_chart(sweep_heatmap(results[metric][stat],
+                                         x_values,
+                                         y_values,
+                                         SWEEP_INPUTS[x_name],
+                                         SWEEP_INPUTS[y_name],
+                                         "{} of the {}".format(stat, metric)),
+                           use_container_width=True)
+
+
+def display_site_screening(electrolyser_type,
+                           base_inputs,
+                           energy_cost_func,
+                           hydrogen_price_func,
+                           water_price_func):
+    """
+    Displays the deterministic screening of a table of candidate sites at
+    the mode values of the electrolyser.
+    """
+
+    with st.expander("Site screening"):
+        col_a, col_b = st.columns([1, 3])
+        sites_file = col_a.file_uploader("Candidate sites (.csv or .npz with "
+                                         "E_o and rate_of_use columns, and "
+                                         "optionally E_cost, water_price, "
+                                         "hydrogen_price or their per year "
+                                         "columns, e.g. E_cost_2030)",
+                                         type=["csv", "npz"])
+        metric = col_a.selectbox("Rank by", ["NPV", "ROI", "IRR", "payback",
+                                             "LCOH"])
+        size = col_a.number_input("Shortlist size", value=20, min_value=1,
+                                  step=1, format="%d")
+        with_irr = col_a.checkbox("Compute the IRR (slower)",
+                                  value=metric == "IRR")
+
+        if sites_file is None:
+            return
+
+        metrics = ("NPV", "ROI", "IRR", "payback", "LCOH") if with_irr or \
+                  metric == "IRR" else ("NPV", "ROI", "payback", "LCOH")
+        # Unreadable files and non numeric or missing columns
+        try:
+            sites = load_sites(sites_file)
+            results = screen_sites(
+                        sites,
+                        electrolyser_type,
+                        energy_cost_func,
+                        hydrogen_price_func,
+                        water_price_func,
+                        discount_rate=base_inputs["discount_rate"],
+                        efficiency_reduction_rate=base_inputs[
+                                                "efficiency_reduction_rate"],
+                        modes={name: base_inputs[name] for name in
+                               ("efficiency", "lifetime", "capital_cost")},
+                        metrics=metrics)
+        except (ValueError, TypeError, KeyError) as error:
+            col_a.error("Invalid sites table: {}".format(error))
+            return
+
+        columns = ("site", "valid") + metrics
+        invalid = np.flatnonzero(~results["valid"])
+        if invalid.size:
+            col_a.warning("{} sites skipped (power output <= 0, rate of use "
+                          "outside (0, 1] or missing values), e.g. rows {}"
+                          .format(invalid.size,
+                                  ", ".join(str(i + 1)
+                                            for i in invalid[:10])))
+        col_b.write("{} sites screened, best {} by {}".format(
+                                        results["valid"].sum(), size, metric))
+        col_b.dataframe([{column: results[column][i] for column in
+                          columns if column != "valid"}
+                         for i in shortlist(results, metric, size)])
+
+        results_csv = "\n".join([",".join(columns)] + \
+                                 [",".join(str(results[column][i])
+                                           for column in columns)
+                                  for i in range(len(results["site"]))])
+        col_b.download_button("Download screening results (CSV)",
+                              results_csv,
+                              file_name="site_screening.csv",
+                              mime="text/csv")
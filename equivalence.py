@@ -0,0 +1,339 @@
+import sys
+import numpy as np
+from scipy import interpolate
+import numpy_financial as npf
+from typing import *
+
+from functions import calculate_profitability_V3, profitability_batch,\
+                      cash_flow, h2_cost
+from pipeline import SimulationPipeline, SAMPLED_INPUTS
+from site_screening import site_price_curve
+
+# Equivalence harness of the profitability engines.
+# Random valid inputs (with the edge cases of the model) are evaluated with
+# the scalar reference loop and with every registered engine, and the ROI,
+# IRR, payback year and hydrogen cost must agree within TOLERANCES. Run it
+# with `python equivalence.py [scenarios] [cases per scenario] [seed]`.
+
+CHECKED_METRICS = ("ROI", "IRR", "payback", "LCOH")
+
+# (relative, absolute) tolerance by metric. The IRR is rounded to 5
+# decimals, so two engines may round to neighbouring values.
+TOLERANCES = {"ROI": (1e-7, 1e-6),
+              "IRR": (0.0, 1.01e-5),
+              "payback": (0.0, 0.0),
+              "LCOH": (1e-9, 1e-9)}
+
+ENGINES = {}
+
+
+def register_engine(name:str) -> Callable:
+    """
+    Decorator that registers an engine in the harness. An engine takes the
+    case arrays (see `generate_cases`, plus the "price_kind" interpolation
+    kind of the curves) and the price curves, and returns the
+    CHECKED_METRICS arrays (payback year 0 when never recovered).
+    """
+    def register(engine:Callable) -> Callable:
+        ENGINES[name] = engine
+        return engine
+    return register
+
+
+def reference_profitability(efficiency:float,
+                            efficiency_reduction_rate:float,
+                            CAPEX_sys:float,
+                            lifetime:float,
+                            E_o:float,
+                            rate_of_use:float,
+                            discount_rate:float,
+                            E_cost:Callable,
+                            hydrogen_price:Callable,
+                            water_price:Callable) -> tuple:
+    """
+    Scalar reference: the original year by year loop of
+    calculate_profitability_V3 / total_return_V2.
+    """
+    efficiency_reduction_rate_per_year = efficiency_reduction_rate * \
+                                         rate_of_use * 365 * 24/10000
+    OPEX_frac_fun = interpolate.interp1d(
+                                        [1000, 5000, 20000],
+                                        [0.04, 0.03, 0.02],
+                                        fill_value=(0.04, 0.02),
+                                        bounds_error = False
+                                        )
+    OPEX = OPEX_frac_fun(E_o) * CAPEX_sys
+    lifetime_years = int(np.floor(lifetime * 1000 /(rate_of_use * 24 *365)))
+
+    h2_cost_arr = np.zeros(lifetime_years +2)
+    life_span = np.arange(2022, 2022 + lifetime_years + 2, 1)
+    total_income = -CAPEX_sys
+    E_year = E_o * rate_of_use * 365 * 24 # [kWh]
+    cash_flow_arr = np.zeros(lifetime_years +2)
+    cash_flow_arr[0] = -CAPEX_sys
+    return_time = False
+    efficiency_i = efficiency
+
+    for i, year in enumerate(life_span[1:]):
+        cf = cash_flow(E_year, E_cost(year), efficiency_i, OPEX,
+                       hydrogen_price(year), water_price(year))
+        h2_cost_arr[i+1] = h2_cost(E_year, E_cost(year), efficiency_i, OPEX,
+                                   water_price(year))
+        total_income += cf/(1+discount_rate)**(i+1)
+        cash_flow_arr[i+1] = cf
+        if not return_time and total_income > 0:
+            return_time = year
+        efficiency_i += efficiency_i * efficiency_reduction_rate_per_year
+
+    ROI = total_income/CAPEX_sys *100
+    return ROI, round(npf.irr(cash_flow_arr), 5), return_time, \
+           np.mean(h2_cost_arr)
+
+
+def _scalar_engine(profitability:Callable, cases:dict, E_cost:Callable,
+                   hydrogen_price:Callable, water_price:Callable) -> dict:
+
+    results = np.array([profitability(cases["efficiency"][i],
+                                      cases["efficiency_reduction_rate"][i],
+                                      cases["CAPEX_sys"][i],
+                                      cases["lifetime"][i],
+                                      cases["E_o"][i],
+                                      cases["rate_of_use"][i],
+                                      cases["discount_rate"][i],
+                                      E_cost,
+                                      hydrogen_price,
+                                      water_price)
+                        for i in range(len(cases["efficiency"]))],
+                       dtype=float).reshape(-1, len(CHECKED_METRICS))
+    return dict(zip(CHECKED_METRICS, results.T))
+
+
+def reference_engine(cases:dict, E_cost:Callable, hydrogen_price:Callable,
+                     water_price:Callable) -> dict:
+    return _scalar_engine(reference_profitability, cases, E_cost,
+                          hydrogen_price, water_price)
+
+
+@register_engine("calculate_profitability_V3")
+def _V3_engine(cases:dict, E_cost:Callable, hydrogen_price:Callable,
+               water_price:Callable) -> dict:
+
+    def profitability(efficiency, efficiency_reduction_rate, CAPEX_sys,
+                      lifetime, E_o, rate_of_use, *args):
+        return calculate_profitability_V3(efficiency,
+                                          efficiency_reduction_rate,
+                                          CAPEX_sys,
+                                          lifetime,
+                                          E_o,
+                                          cases["electrolyser_type"],
+                                          rate_of_use,
+                                          *args)
+
+    return _scalar_engine(profitability, cases, E_cost, hydrogen_price,
+                          water_price)
+
+
+@register_engine("profitability_batch")
+def _batch_engine(cases:dict, E_cost:Callable, hydrogen_price:Callable,
+                  water_price:Callable) -> dict:
+    return profitability_batch(cases["efficiency"],
+                               cases["efficiency_reduction_rate"],
+                               cases["CAPEX_sys"],
+                               cases["lifetime"],
+                               cases["E_o"],
+                               cases["electrolyser_type"],
+                               cases["rate_of_use"],
+                               cases["discount_rate"],
+                               E_cost,
+                               hydrogen_price,
+                               water_price,
+                               metrics=CHECKED_METRICS)
+
+
+@register_engine("SimulationPipeline")
+def _pipeline_engine(cases:dict, E_cost:Callable, hydrogen_price:Callable,
+                     water_price:Callable) -> dict:
+    # The cases run one after the other on the same pipeline, with point
+    # distributions of the sampled inputs (antithetic draws allow a zero
+    # width). Every case is reached in two runs, the second one changing a
+    # single input (in turn), so a stage that misses an input in its key
+    # returns stale values.
+    pipeline = SimulationPipeline(0)
+    prices = [(curve.x, curve.y, cases["price_kind"]) for curve in
+              (E_cost, hydrogen_price, water_price)]
+    names = SAMPLED_INPUTS + ("efficiency_reduction_rate", "E_o",
+                              "rate_of_use", "discount_rate")
+
+    def run(inputs):
+        return pipeline.run(1,
+                            {name: (inputs[name],) * 3 for name in
+                             SAMPLED_INPUTS},
+                            inputs["efficiency_reduction_rate"],
+                            inputs["E_o"],
+                            cases["electrolyser_type"],
+                            inputs["rate_of_use"],
+                            inputs["discount_rate"],
+                            *prices,
+                            estimator="antithetic")
+
+    results = {metric: [] for metric in CHECKED_METRICS}
+    inputs = {name: cases[name][0] for name in names}
+    for i in range(len(cases["efficiency"])):
+        last = names[i % len(names)]
+        inputs.update({name: cases[name][i] for name in names
+                       if name != last})
+        run(inputs)
+        inputs[last] = cases[last][i]
+        case_results = run(inputs)
+        for metric in CHECKED_METRICS:
+            results[metric].append(case_results[metric][0])
+    return {metric: np.array(values) for metric, values in results.items()}
+
+
+@register_engine("site_price_curve")
+def _site_curve_engine(cases:dict, E_cost:Callable, hydrogen_price:Callable,
+                       water_price:Callable) -> dict:
+    # The curves as per year price columns of a sites table, interpolated
+    # site by site as in the site screening
+    n = len(cases["efficiency"])
+    sites = {}
+    for name, curve in (("E_cost", E_cost),
+                        ("hydrogen_price", hydrogen_price),
+                        ("water_price", water_price)):
+        sites.update({"{}_{}".format(name, int(year)): np.full(n, value)
+                      for year, value in zip(curve.x, curve.y)})
+    curves = [site_price_curve(sites, name, None, cases["price_kind"])
+              for name in ("E_cost", "hydrogen_price", "water_price")]
+    return profitability_batch(cases["efficiency"],
+                               cases["efficiency_reduction_rate"],
+                               cases["CAPEX_sys"],
+                               cases["lifetime"],
+                               cases["E_o"],
+                               cases["electrolyser_type"],
+                               cases["rate_of_use"],
+                               cases["discount_rate"],
+                               *curves,
+                               metrics=CHECKED_METRICS)
+
+
+def generate_price_curves(rng:np.random.Generator
+                          ) -> Tuple[Callable, Callable, Callable, str]:
+    """
+    Random price curves with random interpolation kind. One scenario in four
+    has hydrogen prices so low that the cash flows are all negative (no IRR
+    root).
+    """
+    years = [2022, 2025, 2030, 2040, 2050, 2060]
+    kind = rng.choice(["linear", "nearest"])
+    hydrogen_range = (0.0, 0.5) if rng.random() < 0.25 else (3.0, 18.0)
+    curves = [interpolate.interp1d(years,
+                                   rng.uniform(low, high, len(years)),
+                                   kind=kind,
+                                   fill_value="extrapolate")
+              for low, high in ((0.0, 0.2), hydrogen_range, (0.0, 10.0))]
+    return (*curves, kind)
+
+
+def generate_cases(n:int, rng:np.random.Generator,
+                   electrolyser_type:str = "PEM") -> dict:
+    """
+    Random valid inputs. A part of the cases is forced to the edge cases of
+    the model: lifetimes of 0 and 1 years, rates of use near zero, no
+    degradation and plants outside the OPEX table.
+    """
+    cases = {"efficiency": rng.uniform(40, 90, n),
+             "efficiency_reduction_rate": rng.uniform(0, 0.1, n),
+             "CAPEX_sys": rng.uniform(300, 1500, n) * 15000,
+             "lifetime": rng.uniform(20, 90, n),
+             "E_o": rng.uniform(1000, 20000, n),
+             "rate_of_use": rng.uniform(0.05, 1, n),
+             "discount_rate": rng.uniform(0, 0.2, n),
+             "electrolyser_type": electrolyser_type}
+
+    edge = rng.integers(0, 8, n)
+    # Lifetime of 0 or 1 years
+    short = edge < 2
+    cases["lifetime"][short] = (edge[short] + rng.uniform(0, 1, short.sum())) *\
+                               cases["rate_of_use"][short] * 365 * 24/1000
+    # Rate of use near zero
+    rare = edge == 2
+    cases["rate_of_use"][rare] = rng.uniform(0.02, 0.05, rare.sum())
+    cases["lifetime"][rare] = rng.uniform(1, 10, rare.sum())
+    # No degradation, no discount
+    cases["efficiency_reduction_rate"][edge == 3] = 0.0
+    cases["discount_rate"][edge == 3] = 0.0
+    # Plants outside the OPEX table
+    outside = edge == 4
+    cases["E_o"][outside] = rng.choice([500.0, 50000.0], outside.sum())
+    return cases
+
+
+def compare(reference:dict, candidate:dict) -> List[tuple]:
+    """
+    Returns the (metric, case, reference value, candidate value) of every
+    disagreement beyond TOLERANCES. NaN (an IRR without root) only agrees
+    with NaN.
+    """
+    mismatches = []
+    for metric in CHECKED_METRICS:
+        expected = np.asarray(reference[metric], dtype=float)
+        actual = np.asarray(candidate[metric], dtype=float)
+        rtol, atol = TOLERANCES[metric]
+        agree = np.isclose(actual, expected, rtol=rtol, atol=atol,
+                           equal_nan=True)
+        mismatches += [(metric, int(i), expected[i], actual[i])
+                       for i in np.flatnonzero(~agree)]
+    return mismatches
+
+
+def check_equivalence(engines:Optional[Iterable[str]] = None,
+                      scenarios:int = 20,
+                      cases:int = 100,
+                      seed:int = 0) -> Dict[str, List[tuple]]:
+    """
+    Runs the registered engines against the reference over random
+    scenarios (price curves) and cases.
+
+    Returns:
+    -------
+    dict -> {engine: list of (scenario, metric, case, reference, candidate)}
+    """
+    rng = np.random.default_rng(seed)
+    engines = list(engines or ENGINES)
+    mismatches = {name: [] for name in engines}
+
+    for scenario in range(scenarios):
+        E_cost, hydrogen_price, water_price, kind = generate_price_curves(rng)
+        scenario_cases = generate_cases(cases, rng)
+        scenario_cases["price_kind"] = kind
+        reference = reference_engine(scenario_cases, E_cost,
+                                     hydrogen_price, water_price)
+        for name in engines:
+            candidate = ENGINES[name](scenario_cases, E_cost,
+                                      hydrogen_price, water_price)
+            mismatches[name] += [(scenario, *mismatch) for mismatch in
+                                 compare(reference, candidate)]
+    return mismatches
+
+
+def assert_equivalent(engines:Optional[Iterable[str]] = None, **kwargs):
+    """
+    Raises an AssertionError listing the disagreements of the engines.
+    """
+    mismatches = check_equivalence(engines, **kwargs)
+    failed = {name: found for name, found in mismatches.items() if found}
+    if failed:
+        raise AssertionError("\n".join(
+                    "{}: {} mismatches, first: {}".format(name, len(found),
+                                                          found[:5])
+                    for name, found in failed.items()))
+
+
+if __name__ == "__main__":
+    arguments = [int(argument) for argument in sys.argv[1:4]]
+    mismatches = check_equivalence(None, *arguments)
+    for name, found in mismatches.items():
+        print("{}: {}".format(name, "OK" if not found else
+                              "{} mismatches, first: {}".format(len(found),
+                                                                found[:5])))
+    sys.exit(any(mismatches.values()))
@@ -1,6 +1,6 @@
-from scipy import interpolate
 import numpy as np
 import json
+import warnings
 from typing import *
 from scipy.optimize import fsolve, root_scalar, least_squares
 import numpy_financial as npf
@@ -9,26 +9,133 @@ import numpy_financial as npf
 with open('electrolyser_params.json') as json_file:
     params = json.load(json_file)
 
+HOURS_PER_YEAR = 365 * 24
+
+# Operating cost as a fraction of the CAPEX based on the operating energy
+# Source (https://www.fch.europa.eu/sites/default/files/FCH%20Docs/171121_FCH2JU_Application-Package_WG5_P2H_Green%20hydrogen%20%28ID%202910583%29%20%28ID%202911641%29.pdf)
+OPEX_FRAC_POWER = np.array([1000, 5000, 20000]) # [kW]
+OPEX_FRAC = np.array([0.04, 0.03, 0.02])
+
+
+class CostModel:
+    """
+    Cost model of one electrolyser type, built once from the IRENA data in
+    electrolyser_params.json. All the conversions accept scalars or arrays.
+
+    Arguments:
+    ---------
+    electrolyser_type: str -> Electrolyser type (key of the parameter file)
+
+    electrolyser_data: dict -> Parameters of the electrolysers
+    """
+
+    RANGES = ("efficiency", "lifetime", "stack cost", "full system cost")
+
+    def __init__(self, electrolyser_type:str, electrolyser_data:dict = params):
+
+        if electrolyser_type not in electrolyser_data:
+            raise ValueError("Unknown electrolyser type: {}".format(
+                                                            electrolyser_type))
+        data = electrolyser_data[electrolyser_type]
+
+        self.electrolyser_type = electrolyser_type
+        self.pressure = data.get("Pressure")
+        self.ranges = {}
+        for name in self.RANGES:
+            low, high = float(data[name]["min"]), float(data[name]["max"])
+            if not 0 < low <= high:
+                raise ValueError("Invalid {} range for {}: [{}, {}]".format(
+                                        name, electrolyser_type, low, high))
+            self.ranges[name] = (low, high)
+
+    def opex_fraction(self, E_o:Union[float, np.ndarray]
+                      ) -> Union[float, np.ndarray]:
+        """
+        Yearly operating cost as a fraction of the CAPEX, clamped to the
+        fractions of the smallest and largest plants outside the table.
+        """
+        return np.interp(E_o, OPEX_FRAC_POWER, OPEX_FRAC)
+
+    def opex_fraction_slope(self, E_o:Union[float, np.ndarray]
+                            ) -> Union[float, np.ndarray]:
+        """
+        Derivative of the OPEX fraction with respect to the operating energy
+        (1/kW), zero outside the table.
+        """
+        slopes = np.diff(OPEX_FRAC) / np.diff(OPEX_FRAC_POWER)
+        segment = np.searchsorted(OPEX_FRAC_POWER, E_o, side="right") - 1
+        inside = (segment >= 0) & (segment < slopes.size)
+        return np.where(inside, slopes[np.clip(segment, 0, slopes.size - 1)],
+                        0.0)
+
+    def lifetime_years(self, lifetime:Union[float, np.ndarray],
+                       rate_of_use:Union[float, np.ndarray]
+                       ) -> Union[int, np.ndarray]:
+        """
+        Converts the lifetime (thousands of hours) to whole operating years.
+        """
+        lifetime_hours = np.asarray(lifetime) * 1000 # hours
+        lifetime_years = np.floor(lifetime_hours /(rate_of_use * HOURS_PER_YEAR))
+        if np.ndim(lifetime_years) == 0:
+            return int(lifetime_years)
+        return lifetime_years.astype(int)
+
+    def degradation_per_year(self,
+                             efficiency_reduction_rate:Union[float, np.ndarray],
+                             rate_of_use:Union[float, np.ndarray]
+                             ) -> Union[float, np.ndarray]:
+        """
+        Converts the efficiency reduction rate (per ten thousand hours) to a
+        yearly rate.
+        """
+        return efficiency_reduction_rate * rate_of_use * HOURS_PER_YEAR/10000
+
+    def in_range(self, name:str, values:Union[float, np.ndarray]
+                 ) -> Union[bool, np.ndarray]:
+        """
+        Checks if the values are inside the IRENA range of the parameter.
+        """
+        low, high = self.ranges[name]
+        return (low <= np.asarray(values)) & (np.asarray(values) <= high)
+
+    def sample_uniform(self, name:str, size:Optional[int] = None
+                       ) -> Union[float, np.ndarray]:
+        """
+        Samples the parameter uniformly in its IRENA range.
+        """
+        return np.random.uniform(*self.ranges[name], size)
+
+
+_cost_models = {}
+
+
+def get_cost_model(electrolyser_type:str) -> CostModel:
+    """
+    Returns the (cached) cost model of the electrolyser type.
+    """
+    if electrolyser_type not in _cost_models:
+        _cost_models[electrolyser_type] = CostModel(electrolyser_type)
+    return _cost_models[electrolyser_type]
+
 
 def calculate_lifetime(
     electrolyser_type: str,
     rate_of_use:float,
     )-> tuple:
 
+    cost_model = get_cost_model(electrolyser_type)
+
     # Step 1: Get the electrolyser lifetime from the IRENA data.
 
-    base_lifetime = np.random.uniform(
-                                params[electrolyser_type]["lifetime"]["min"], 
-                                params[electrolyser_type]["lifetime"]["max"]
-                                ) # thousands of hours
+    base_lifetime = cost_model.sample_uniform("lifetime") # thousands of hours
 
     lifetime_hours = base_lifetime * 1000 # hours
     
     # Step 2: Using the rate of use, calculate the lifetime of the electrolyser
     # in years.
-    lifetime_years = np.floor(lifetime_hours /(rate_of_use * 24 *365)) # years
+    lifetime_years = cost_model.lifetime_years(base_lifetime, rate_of_use)
 
-    return lifetime_hours, int(lifetime_years)
+    return lifetime_hours, lifetime_years
 
 def electrolyser_params(E_o, elec_type, rate_of_use) -> dict:
     """
@@ -45,30 +152,19 @@ def electrolyser_params(E_o, elec_type, rate_of_use) -> dict:
     dict -> Electrolyser parameters
     """
     
+    cost_model = get_cost_model(elec_type)
+
     # Efficiency of the electrolyser
-    efficiency = np.random.uniform(
-                                    params[elec_type]["efficiency"]["min"], 
-                                    params[elec_type]["efficiency"]["max"]
-                                    )# [kWh/KgH2]
+    efficiency = cost_model.sample_uniform("efficiency")# [kWh/KgH2]
     # Capital cost of the electrolyser stack
-    CAPEX_o = E_o * np.random.uniform(
-                                    params[elec_type]["stack cost"]["min"], 
-                                    params[elec_type]["stack cost"]["max"]
-                                    )# [USD]
+    CAPEX_o = E_o * cost_model.sample_uniform("stack cost")# [USD]
     
     # Capital cost of the electrolyser system
     
-    CAPEX_sys = E_o * np.random.uniform(
-                                params[elec_type]["full system cost"]["min"], 
-                                params[elec_type]["full system cost"]["max"]
-                                ) # [USD]
+    CAPEX_sys = E_o * cost_model.sample_uniform("full system cost") # [USD]
     # Now we calculate the operating cost of the electrolyser
     # As a fraction of the CAPEX based on the operating energy
-    # Source (https://www.fch.europa.eu/sites/default/files/FCH%20Docs/171121_FCH2JU_Application-Package_WG5_P2H_Green%20hydrogen%20%28ID%202910583%29%20%28ID%202911641%29.pdf)
-    OPEX_frac_fun = interpolate.interp1d(
-                                        [1000, 5000, 20000], 
-                                        [0.04, 0.03, 0.02], ) 
-    Opex_frac = OPEX_frac_fun(E_o)
+    Opex_frac = cost_model.opex_fraction(E_o)
     
     OPEX_o = Opex_frac * CAPEX_o # [USD/year]
     OPEX_sys = Opex_frac * CAPEX_sys # [USD/year]
@@ -149,6 +245,159 @@ def h2_cost(    E_year:float,
 
     
 
+PROFITABILITY_METRICS = ("NPV",
+                         "ROI",
+                         "IRR",
+                         "payback",
+                         "LCOH",
+                         "cumulative",
+                         "cash_flows",
+                         "discounted_cash_flows")
+
+
+def _evaluate_curve(curve:Callable, years:np.ndarray) -> np.ndarray:
+    """
+    Evaluates a price curve (e.g. an interp1d) over an array of years. A
+    curve may also return one row of prices per case (cases, years). A curve
+    that only takes one year at a time is evaluated year by year.
+    """
+    try:
+        values = np.asarray(curve(years), dtype=float)
+    except (TypeError, ValueError, KeyError):
+        values = np.stack([np.asarray(curve(year), dtype=float)
+                           for year in years], axis=-1)
+    return np.broadcast_to(values, np.broadcast_shapes(values.shape,
+                                                       years.shape))
+
+
+def profitability_engine(lifetime_years:int,
+                         E_o: float,
+                         rate_of_use:float,
+                         efficiency:float,
+                         efficiency_reduction_rate_per_year:float,
+                         CAPEX:float,
+                         OPEX:float,
+                         discount_rate:float,
+                         E_cost:Callable,
+                         hydrogen_price:Callable,
+                         water_price:Callable,
+                         metrics:Iterable[str] = PROFITABILITY_METRICS
+                         )->dict:
+    """
+    Calculates the requested profitability metrics of the electrolyser.
+
+    Only the metrics listed in `metrics` are computed, so a caller that only
+    needs the NPV skips the IRR root finding and the hydrogen cost series.
+
+    Arguments:
+    ---------
+    lifetime_years: int -> Lifetime of the electrolyser in years
+
+    E_o: float -> Operating energy of the electrolyser (kW)
+
+    rate_of_use: float -> Fraction of the day the electrolyser is used
+
+    efficiency: float -> Initial efficiency of the electrolyser [kWh/KgH2]
+
+    efficiency_reduction_rate_per_year: float -> Yearly efficiency reduction
+
+    CAPEX: float -> Capital cost of the electrolyser system (USD)
+
+    OPEX: float -> Yearly operational cost (USD)
+
+    discount_rate: float -> Discount rate
+
+    E_cost, hydrogen_price, water_price: Callable -> Price curves by year
+
+    metrics: Iterable[str] -> Any of PROFITABILITY_METRICS:
+        "NPV": Net present value (USD)
+        "ROI": Return on investment (%)
+        "IRR": Internal rate of return
+        "payback": Payback year (False if the investment is never recovered)
+        "LCOH": Average hydrogen cost of production (USD/Kg)
+        "cumulative": Cumulative discounted return by year (USD)
+        "cash_flows": Undiscounted cash flows by year (USD)
+        "discounted_cash_flows": Discounted cash flows by year (USD)
+
+    Returns:
+    -------
+    dict -> Requested metrics, plus the "life span" array of years.
+    """
+    metrics = set(metrics)
+    unknown = metrics.difference(PROFITABILITY_METRICS)
+    if unknown:
+        raise ValueError("Unknown profitability metrics: {}".format(
+                                                        sorted(unknown)))
+
+    life_span = np.arange(2022, 2022 + lifetime_years + 2, 1)
+    years = life_span[1:]
+    periods = np.arange(1, lifetime_years + 2)
+
+    results = {"life span": life_span}
+
+    E_year = E_o * rate_of_use * HOURS_PER_YEAR # [kWh]
+
+    # The efficiency reduction is compounded once per operating year
+    efficiency_i = efficiency * \
+                   (1 + efficiency_reduction_rate_per_year)**(periods - 1)
+
+    energy_cost = _evaluate_curve(E_cost, years)
+    water_cost = _evaluate_curve(water_price, years)
+
+    if "LCOH" in metrics:
+        h2_cost_arr = np.zeros(lifetime_years + 2)
+        h2_cost_arr[1:] = h2_cost(E_year,
+                                  energy_cost,
+                                  efficiency_i, OPEX,
+                                  water_cost)
+        results["LCOH"] = np.mean(h2_cost_arr)
+
+    if not metrics.difference({"LCOH"}):
+        return results
+
+    cash_flow_arr = np.empty(lifetime_years + 2)
+    cash_flow_arr[0] = -CAPEX
+    cash_flow_arr[1:] = cash_flow(E_year,
+                                  energy_cost,
+                                  efficiency_i, OPEX,
+                                  _evaluate_curve(hydrogen_price, years),
+                                  water_cost)
+
+    if "cash_flows" in metrics:
+        results["cash_flows"] = cash_flow_arr
+
+    if "IRR" in metrics:
+        results["IRR"] = round(npf.irr(cash_flow_arr), 5)
+
+    if not metrics.intersection({"NPV", "ROI", "payback", "cumulative",
+                                 "discounted_cash_flows"}):
+        return results
+
+    discounted_arr = np.zeros(lifetime_years + 2)
+    discounted_arr[1:] = cash_flow_arr[1:]/(1+discount_rate)**periods
+
+    cumulative_return = np.cumsum(discounted_arr) - CAPEX
+    NPV = cumulative_return[-1]
+
+    if "discounted_cash_flows" in metrics:
+        results["discounted_cash_flows"] = discounted_arr
+
+    if "cumulative" in metrics:
+        results["cumulative"] = cumulative_return
+
+    if "NPV" in metrics:
+        results["NPV"] = NPV
+
+    if "ROI" in metrics:
+        results["ROI"] = NPV/CAPEX *100
+
+    if "payback" in metrics:
+        recovered = np.flatnonzero(cumulative_return[1:] > 0)
+        results["payback"] = years[recovered[0]] if recovered.size else False
+
+    return results
+
+
 def total_return(lifetime_years:int, 
                  E_o: float, 
                  rate_of_use:float,
@@ -168,37 +417,23 @@ def total_return(lifetime_years:int,
     lifetime_years: int -> Lifetime of the electrolyser in years
     
     """
-    cumulative_return = np.zeros(lifetime_years +2)
-    yearly_return = np.zeros(lifetime_years +2)
-    life_span = np.arange(2022, 2022 + lifetime_years + 2, 1)
-
-    total_income = 0
-
-    E_year = E_o * rate_of_use * 365 * 24 # [kWh]
-
-    efficiency_i = efficiency
-    
-    for i, year in enumerate(life_span[1:]):
-
-        yearly_income = cash_flow(E_year, 
-                                  E_cost(year), 
-                                  efficiency_i, 
-                                  OPEX, 
-                                  hydrogen_price(year), 
-                                  water_price(year))/(1+discount_rate)**(i+1)
-        
-        total_income += yearly_income
-        
-        yearly_return[i+1] = yearly_income
-        
-        cumulative_return[i+1] = total_income
-
-        # Now we account for the efficiency reduction
-        efficiency_i += efficiency_i * efficiency_reduction_rate_per_year
-
-    
-
-    return cumulative_return, yearly_return, life_span
+    results = profitability_engine(lifetime_years,
+                                   E_o,
+                                   rate_of_use,
+                                   efficiency,
+                                   efficiency_reduction_rate_per_year,
+                                   0,
+                                   OPEX,
+                                   discount_rate,
+                                   E_cost,
+                                   hydrogen_price,
+                                   water_price,
+                                   metrics=("cumulative",
+                                            "discounted_cash_flows")
+                                   )
+
+    return results["cumulative"], results["discounted_cash_flows"], \
+           results["life span"]
 
 
 
@@ -222,56 +457,22 @@ def total_return_V2(lifetime_years:int,
     lifetime_years: int -> Lifetime of the electrolyser in years
     
     """
-    
-    h2_cost_arr = np.zeros(lifetime_years +2)
-    life_span = np.arange(2022, 2022 + lifetime_years + 2, 1)
+    results = profitability_engine(lifetime_years,
+                                   E_o,
+                                   rate_of_use,
+                                   efficiency,
+                                   efficiency_reduction_rate_per_year,
+                                   CAPEX,
+                                   OPEX,
+                                   discount_rate,
+                                   E_cost,
+                                   hydrogen_price,
+                                   water_price,
+                                   metrics=("IRR", "NPV", "payback", "LCOH")
+                                   )
 
-    total_income = -CAPEX
-
-    E_year = E_o * rate_of_use * 365 * 24 # [kWh]
-
-    cash_flow_arr = np.zeros(lifetime_years +2)
-    
-    cash_flow_arr[0] = -CAPEX
-
-    return_time = False
-
-    efficiency_i = efficiency
-
-    for i, year in enumerate(life_span[1:]):
-
-        cf =  cash_flow(E_year, 
-                        E_cost(year),
-                        efficiency_i, OPEX, 
-                        hydrogen_price(year), 
-                        water_price(year)
-                        )
-        h2_cost_arr[i+1] = h2_cost(E_year,
-                                    E_cost(year),
-                                    efficiency_i, OPEX,
-                                    water_price(year)
-                                    )
-        yearly_income =cf/(1+discount_rate)**(i+1)
-        
-        total_income += yearly_income
-
-        cash_flow_arr[i+1] = cf
-        
-
-        if not return_time and total_income > 0:
-            return_time = year
-
-        # Now we account for the efficiency reduction
-        efficiency_i += efficiency_i * efficiency_reduction_rate_per_year
-
-
-    IRR = round(npf.irr(cash_flow_arr), 5)
-    
-    NPV = total_income
-
-    avg_h2_cost = np.mean(h2_cost_arr)
-
-    return IRR, NPV, return_time, avg_h2_cost
+    return results["IRR"], results["NPV"], results["payback"], \
+           results["LCOH"]
 
 
 
@@ -324,23 +525,17 @@ def calculate_profitability_V2(
     
     """
 
-    efficiency_reduction_rate_per_year = efficiency_reduction_rate * \
-                                         rate_of_use * 365 * 24/10000
-    # Step 1: Get the electrolyser parameters
-    OPEX_frac_fun = interpolate.interp1d(
-                                        [1000, 5000, 20000], 
-                                        [0.04, 0.03, 0.02], 
-                                        fill_value=(0.04, 0.02)
-                                        ) 
-    Opex_frac = OPEX_frac_fun(E_o)
-
-    OPEX_sys = Opex_frac * CAPEX_sys
+    cost_model = get_cost_model(electrolyser_type)
 
-    lifetime_hours = lifetime * 1000 # hours
+    efficiency_reduction_rate_per_year = cost_model.degradation_per_year(
+                                                    efficiency_reduction_rate,
+                                                    rate_of_use)
+    # Step 1: Get the electrolyser parameters
+    OPEX_sys = cost_model.opex_fraction(E_o) * CAPEX_sys
     
     # Step 2: Using the rate of use, calculate the lifetime of the electrolyser
     # in years.
-    lifetime_years = int(np.floor(lifetime_hours /(rate_of_use * 24 *365)))
+    lifetime_years = cost_model.lifetime_years(lifetime, rate_of_use)
 
     # Step 2: Calculate the total return of the electrolyser
     cumulative_return, yearly_return, life_span = total_return(
@@ -362,6 +557,62 @@ def calculate_profitability_V2(
     return cumulative_return, yearly_return, life_span
 
 
+def calculate_profitability_metrics(
+    efficiency:float,
+    efficiency_reduction_rate:float,
+    CAPEX_sys:float,
+    lifetime:float,
+    E_o:float,
+    electrolyser_type: str,
+    rate_of_use:float,
+    discount_rate:float,
+    E_cost: Callable,
+    hydrogen_price:Callable,
+    water_price:Callable,
+    metrics:Iterable[str] = PROFITABILITY_METRICS
+    )->dict:
+    """
+    Calculates only the requested profitability metrics of the electrolyser
+    (see `profitability_engine` for the available ones).
+
+    Arguments:
+    ----------
+    Same as `calculate_profitability_V3`, plus
+
+    metrics: Iterable[str] -> Metrics to compute.
+
+    Returns:
+    -------
+    dict -> Requested metrics.
+    """
+    cost_model = get_cost_model(electrolyser_type)
+
+    efficiency_reduction_rate_per_year = cost_model.degradation_per_year(
+                                                    efficiency_reduction_rate,
+                                                    rate_of_use)
+    # Step 1: Get the electrolyser parameters
+    OPEX_sys = cost_model.opex_fraction(E_o) * CAPEX_sys
+    
+    # Step 2: Using the rate of use, calculate the lifetime of the electrolyser
+    # in years.
+    lifetime_years = cost_model.lifetime_years(lifetime, rate_of_use)
+
+    # Step 3: Calculate the requested metrics of the electrolyser
+    return profitability_engine(lifetime_years, 
+                                E_o, 
+                                rate_of_use,
+                                efficiency, 
+                                efficiency_reduction_rate_per_year,
+                                CAPEX_sys,
+                                OPEX_sys, 
+                                discount_rate,
+                                E_cost,
+                                hydrogen_price,
+                                water_price,
+                                metrics=metrics
+                                )
+
+
 def calculate_profitability_V3(
     efficiency:float,
     efficiency_reduction_rate:float,
@@ -383,45 +634,556 @@ def calculate_profitability_V3(
     ----------
 
     """
-    efficiency_reduction_rate_per_year = efficiency_reduction_rate * \
-                                         rate_of_use * 365 * 24/10000
-    # Step 1: Get the electrolyser parameters
-    OPEX_frac_fun = interpolate.interp1d(
-                                        [1000, 5000, 20000], 
-                                        [0.04, 0.03, 0.02], 
-                                        fill_value=(0.04, 0.02),
-                                        bounds_error = False
-                                        ) 
-    Opex_frac = OPEX_frac_fun(E_o)
+    results = calculate_profitability_metrics(efficiency,
+                                              efficiency_reduction_rate,
+                                              CAPEX_sys,
+                                              lifetime,
+                                              E_o,
+                                              electrolyser_type,
+                                              rate_of_use,
+                                              discount_rate,
+                                              E_cost,
+                                              hydrogen_price,
+                                              water_price,
+                                              metrics=("ROI", "IRR",
+                                                       "payback", "LCOH")
+                                              )
+                                                    
+    return results["ROI"], results["IRR"], results["payback"], \
+           results["LCOH"]
 
-    OPEX_sys = Opex_frac * CAPEX_sys
 
-    lifetime_hours = lifetime * 1000 # hours
-    
-    # Step 2: Using the rate of use, calculate the lifetime of the electrolyser
-    # in years.
-    lifetime_years = int(np.floor(lifetime_hours /(rate_of_use * 24 *365)))
+BATCH_METRICS = ("NPV", "ROI", "IRR", "payback", "LCOH")
 
-    # Step 2: Calculate the total return of the electrolyser
-    IRR, NPV, return_time, avg_h2_cost = total_return_V2(   
-                                                        lifetime_years, 
-                                                        E_o, 
-                                                        rate_of_use,
-                                                        efficiency, 
-                                                        efficiency_reduction_rate_per_year,
-                                                        CAPEX_sys,
-                                                        OPEX_sys, 
-                                                        discount_rate,
-                                                        E_cost,
-                                                        hydrogen_price,
-                                                        water_price
-                                                        )
-                                                        
-                                                        
-    
-    ROI = NPV/CAPEX_sys *100
-                                                    
-    return ROI, IRR, return_time, avg_h2_cost
+# The batch model is split in stages (operating schedule, price lookup,
+# cash flows, discounting and metrics) so a caller can cache each of them
+# and only recompute the stages whose inputs changed (see pipeline.py).
+
+
+def operating_schedule(
+    efficiency:Union[float, np.ndarray],
+    efficiency_reduction_rate:Union[float, np.ndarray],
+    CAPEX_sys:Union[float, np.ndarray],
+    lifetime:Union[float, np.ndarray],
+    E_o:Union[float, np.ndarray],
+    electrolyser_type: str,
+    rate_of_use:Union[float, np.ndarray],
+    )->dict:
+    """
+    Calculates the lifetime in years, the year axis and the efficiency of
+    every operating year of a batch of electrolysers.
+
+    The year axis is padded to the longest lifetime and the "active" mask
+    marks the operating years (1 to lifetime_years + 1) of each case.
+
+    Returns:
+    -------
+    dict -> Schedule arrays, with the (cases, years) arrays in the last axis.
+    """
+    if np.any(np.asarray(rate_of_use) <= 0):
+        raise ValueError("The rate of use must be positive")
+
+    cost_model = get_cost_model(electrolyser_type)
+
+    (efficiency, efficiency_reduction_rate, CAPEX_sys, lifetime, E_o,
+     rate_of_use) = np.broadcast_arrays(
+                            *[np.asarray(x, dtype=float) for x in
+                              (efficiency, efficiency_reduction_rate,
+                               CAPEX_sys, lifetime, E_o, rate_of_use)])
+
+    efficiency_reduction_rate_per_year = cost_model.degradation_per_year(
+                                                    efficiency_reduction_rate,
+                                                    rate_of_use)
+    # An array also for scalar inputs, the stages index its last axis
+    lifetime_years = np.asarray(cost_model.lifetime_years(lifetime,
+                                                          rate_of_use))
+    periods = np.arange(1, np.max(lifetime_years, initial=0) + 2)
+
+    OPEX_frac = cost_model.opex_fraction(E_o)
+
+    return {"lifetime years": lifetime_years,
+            "periods": periods,
+            "years": 2022 + periods,
+            "active": periods <= lifetime_years[..., None] + 1,
+            "efficiency": efficiency[..., None] * \
+            (1 + efficiency_reduction_rate_per_year[..., None])**(periods - 1),
+            "CAPEX_sys": CAPEX_sys,
+            "OPEX_sys": OPEX_frac * CAPEX_sys,
+            "E_year": E_o * rate_of_use * HOURS_PER_YEAR, # [kWh]
+            # Inputs of the schedule, used by the gradients
+            "initial efficiency": efficiency,
+            "efficiency reduction rate": efficiency_reduction_rate,
+            "efficiency reduction rate per year":
+                                        efficiency_reduction_rate_per_year,
+            "OPEX fraction": OPEX_frac,
+            "OPEX fraction slope": cost_model.opex_fraction_slope(E_o),
+            "E_o": E_o,
+            "rate of use": rate_of_use}
+
+
+def price_schedule(years:np.ndarray,
+                   price:Callable,
+                   scale:Union[float, np.ndarray] = 1.0) -> np.ndarray:
+    """
+    Evaluates a price curve over the year axis of a schedule, scaled by a
+    (broadcastable) price level.
+    """
+    return _evaluate_curve(price, years) * np.asarray(scale)[..., None]
+
+
+def batch_h2_cost(schedule:dict,
+                  energy_cost:np.ndarray,
+                  water_cost:np.ndarray) -> np.ndarray:
+    """
+    Average hydrogen cost of production of every case of the schedule.
+    """
+    h2_cost_arr = h2_cost(schedule["E_year"][..., None],
+                          energy_cost,
+                          schedule["efficiency"],
+                          schedule["OPEX_sys"][..., None],
+                          water_cost)
+    return np.sum(h2_cost_arr, axis=-1, where=schedule["active"]) / \
+           (schedule["lifetime years"] + 2)
+
+
+def batch_cash_flows(schedule:dict,
+                     energy_cost:np.ndarray,
+                     hydrogen_price:np.ndarray,
+                     water_cost:np.ndarray) -> np.ndarray:
+    """
+    Undiscounted cash flows of the operating years (zero outside them).
+    """
+    cash_flow_arr = cash_flow(schedule["E_year"][..., None],
+                              energy_cost,
+                              schedule["efficiency"],
+                              schedule["OPEX_sys"][..., None],
+                              hydrogen_price,
+                              water_cost)
+    return np.where(schedule["active"], cash_flow_arr, 0.0)
+
+
+def batch_irr(schedule:dict, cash_flow_arr:np.ndarray) -> np.ndarray:
+    """
+    Internal rate of return of every case, as `npf.irr` rounded to 5
+    decimals (NaN without root).
+
+    The flows of a case are -CAPEX and the cash flows of its operating years.
+    When their sign changes once (the usual investment profile) the NPV has a
+    single root in the discount factor x = 1/(1 + IRR) > 0 (Descartes' rule
+    of signs), solved for all those cases at once (see `_single_root_irr`).
+    Without sign change there is no root. The few cases with several sign
+    changes may have several roots and are solved with `npf.irr`, which
+    returns the one closest to zero.
+    """
+    lifetime_years = schedule["lifetime years"]
+    CAPEX_sys = np.broadcast_to(schedule["CAPEX_sys"], lifetime_years.shape)
+
+    flows = np.concatenate([-CAPEX_sys[..., None],
+                            np.where(schedule["active"], cash_flow_arr, 0.0)],
+                           axis=-1).reshape(-1, cash_flow_arr.shape[-1] + 1)
+    last_period = lifetime_years.reshape(-1) + 1
+
+    # Sign changes of the flows, ignoring the zero flows
+    signs = np.sign(flows)
+    periods = np.arange(flows.shape[-1])
+    last_nonzero = np.maximum.accumulate(np.where(signs != 0, periods, -1),
+                                         axis=-1)
+    previous = np.take_along_axis(signs, np.maximum(last_nonzero[:, :-1], 0),
+                                  axis=-1) * (last_nonzero[:, :-1] >= 0)
+    sign_changes = np.sum((signs[:, 1:] != 0) & (previous != 0) & \
+                          (signs[:, 1:] != previous), axis=-1)
+
+    IRR = np.full(len(flows), np.nan)
+    single = (sign_changes == 1) & (signs[:, 0] != 0)
+    IRR[single] = _single_root_irr(flows[single], last_period[single])
+    for case in np.flatnonzero((sign_changes > 1) | (signs[:, 0] == 0)):
+        IRR[case] = npf.irr(flows[case, :last_period[case] + 1])
+    return np.round(IRR, 5).reshape(lifetime_years.shape)
+
+
+def _single_root_irr(flows:np.ndarray, last_period:np.ndarray,
+                     tolerance:float = 1e-12,
+                     max_iterations:int = 200) -> np.ndarray:
+    """
+    IRR of the (cases, periods) flows whose sign changes once, by Newton
+    steps on u = log(x), x = 1/(1 + IRR), kept inside a bisection bracket.
+
+    The NPV sum(flow_t * x**t) is evaluated as is for x <= 1 and divided by
+    x**last_period for x > 1, so that no power overflows. Both have the same
+    root, and their sign tells the side of the root.
+    """
+    periods = np.arange(flows.shape[-1])
+    operating = periods <= last_period[:, None]
+    # Sign of the NPV at x -> 0 (u -> -inf), the opposite above the root
+    first_sign = np.sign(flows[:, 0])
+
+    u = np.zeros(len(flows))
+    low = np.full(len(flows), -50.0)
+    high = np.full(len(flows), 50.0)
+    remaining = np.arange(len(flows))
+    for _ in range(max_iterations):
+        if not remaining.size:
+            break
+        u_r = u[remaining, None]
+        exponents = np.where(u_r <= 0, periods, periods - \
+                             last_period[remaining, None])
+        terms = flows[remaining] * np.exp(np.where(operating[remaining],
+                                                   u_r * exponents, -np.inf))
+        value = np.sum(terms, axis=-1) * first_sign[remaining]
+        slope = np.sum(terms * exponents, axis=-1) * first_sign[remaining]
+
+        # Below the root the NPV has the sign of the first flow
+        below = value > 0
+        low[remaining] = np.where(below, u[remaining], low[remaining])
+        high[remaining] = np.where(below, high[remaining], u[remaining])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = u[remaining] - value / slope
+        bisection = (low[remaining] + high[remaining]) / 2
+        inside = np.isfinite(step) & (step >= low[remaining]) & \
+                 (step <= high[remaining])
+        new_u = np.where(inside, step, bisection)
+
+        converged = (np.abs(new_u - u[remaining]) <= tolerance) | \
+                    (high[remaining] - low[remaining] <= tolerance) | \
+                    (value == 0)
+        u[remaining] = np.where(value == 0, u[remaining], new_u)
+        remaining = remaining[~converged]
+    return np.exp(-u) - 1
+
+
+def batch_cumulative_return(schedule:dict,
+                            cash_flow_arr:np.ndarray,
+                            discount_rate:Union[float, np.ndarray]
+                            ) -> np.ndarray:
+    """
+    Cumulative discounted return (including the CAPEX) by operating year.
+    """
+    discount_rate = np.asarray(discount_rate, dtype=float)
+    return np.cumsum(cash_flow_arr/(1 + discount_rate[..., None])**\
+                     schedule["periods"], axis=-1) - \
+           schedule["CAPEX_sys"][..., None]
+
+
+def batch_return_metrics(schedule:dict,
+                         cumulative_return:np.ndarray,
+                         metrics:Iterable[str] = ("NPV", "ROI", "payback")
+                         ) -> dict:
+    """
+    NPV, ROI and payback year (0 if the investment is never recovered) from
+    the cumulative discounted return.
+    """
+    results = {}
+    NPV = cumulative_return[..., -1]
+
+    if "NPV" in metrics:
+        results["NPV"] = NPV
+
+    if "ROI" in metrics:
+        results["ROI"] = NPV/schedule["CAPEX_sys"] *100
+
+    if "payback" in metrics:
+        recovered = (cumulative_return > 0) & schedule["active"]
+        results["payback"] = np.where(recovered.any(axis=-1),
+                                  schedule["years"][np.argmax(recovered, axis=-1)],
+                                  0)
+
+    return results
+
+
+GRADIENT_INPUTS = ("efficiency",
+                   "efficiency_reduction_rate",
+                   "CAPEX_sys",
+                   "lifetime",
+                   "E_o",
+                   "rate_of_use",
+                   "discount_rate",
+                   "E_cost_scale",
+                   "hydrogen_price_scale",
+                   "water_price_scale")
+
+
+def batch_gradients(schedule:dict,
+                    energy_cost:np.ndarray,
+                    hydrogen_price:np.ndarray,
+                    water_cost:np.ndarray,
+                    discount_rate:Union[float, np.ndarray],
+                    E_cost_scale:Union[float, np.ndarray] = 1.0,
+                    hydrogen_price_scale:Union[float, np.ndarray] = 1.0,
+                    water_price_scale:Union[float, np.ndarray] = 1.0
+                    ) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    Analytic partial derivatives of the NPV, ROI and average hydrogen cost
+    (LCOH) of every case with respect to the GRADIENT_INPUTS.
+
+    The cash flow of the operating year p is
+
+        cf_p = E_year * (a_p/efficiency_p - e_p) - OPEX,
+        a_p = h_p - 9*w_p/997,
+        efficiency_p = efficiency * (1 + g)**(p - 1),
+
+    so the derivatives follow from the chain rule through E_year, OPEX,
+    efficiency_p, the degradation per year g and the discount factors. The
+    lifetime in years is a whole number of years, so the derivatives with
+    respect to the lifetime are zero (and the rate of use only acts through
+    the yearly energy and degradation).
+
+    Arguments:
+    ---------
+    schedule: dict -> Output of `operating_schedule`
+
+    energy_cost, hydrogen_price, water_cost: np.ndarray -> Unscaled prices by
+        year (`price_schedule` without scale)
+
+    discount_rate: float or array -> Discount rate
+
+    E_cost_scale, hydrogen_price_scale, water_price_scale: float or array ->
+        Multipliers of the price curves
+
+    Returns:
+    -------
+    dict -> {"NPV", "ROI", "LCOH": {input: derivative array}}
+    """
+    expand = lambda x: np.asarray(x, dtype=float)[..., None]
+
+    active = schedule["active"]
+    periods = schedule["periods"]
+    efficiency_p = schedule["efficiency"]
+    E_year = expand(schedule["E_year"])
+    OPEX = expand(schedule["OPEX_sys"])
+    CAPEX = schedule["CAPEX_sys"]
+    g = expand(schedule["efficiency reduction rate per year"])
+    u = expand(schedule["rate of use"])
+    E_o = expand(schedule["E_o"])
+    r = expand(discount_rate)
+
+    e = energy_cost * expand(E_cost_scale)
+    h = hydrogen_price * expand(hydrogen_price_scale)
+    w = water_cost * expand(water_price_scale)
+    a = h - 9*w/997
+
+    discount = np.where(active, (1 + r)**-periods, 0.0)
+
+    # Derivatives of the yearly cash flows
+    dcf_defficiency_p = -E_year * a / efficiency_p**2
+    dcf_dE_year = a/efficiency_p - e
+    defficiency_p_dg = efficiency_p * (periods - 1) / (1 + g)
+    dg_dd = u * HOURS_PER_YEAR/10000
+    dg_du = expand(schedule["efficiency reduction rate"]) * HOURS_PER_YEAR/10000
+    dOPEX_dE_o = expand(schedule["OPEX fraction slope"]) * expand(CAPEX)
+
+    dcf = {"efficiency": dcf_defficiency_p * efficiency_p / \
+                         expand(schedule["initial efficiency"]),
+           "efficiency_reduction_rate": dcf_defficiency_p * \
+                                        defficiency_p_dg * dg_dd,
+           "CAPEX_sys": -expand(schedule["OPEX fraction"]) * \
+                        np.ones_like(efficiency_p),
+           "E_o": dcf_dE_year * u * HOURS_PER_YEAR - dOPEX_dE_o,
+           "rate_of_use": dcf_dE_year * E_o * HOURS_PER_YEAR + \
+                          dcf_defficiency_p * defficiency_p_dg * dg_du,
+           "E_cost_scale": -E_year * energy_cost,
+           "hydrogen_price_scale": E_year * hydrogen_price / efficiency_p,
+           "water_price_scale": -E_year * 9*water_cost / (997*efficiency_p)}
+
+    dNPV = {name: np.sum(values * discount, axis=-1)
+            for name, values in dcf.items()}
+    dNPV["CAPEX_sys"] = dNPV["CAPEX_sys"] - 1
+    cash_flow_arr = E_year * (a/efficiency_p - e) - OPEX
+    dNPV["discount_rate"] = np.sum(-cash_flow_arr * periods * discount / \
+                                   (1 + r), axis=-1)
+    dNPV["lifetime"] = np.zeros(CAPEX.shape)
+
+    NPV = np.sum(cash_flow_arr * discount, axis=-1) - CAPEX
+    dROI = {name: 100 * values / CAPEX for name, values in dNPV.items()}
+    dROI["CAPEX_sys"] = 100 * (dNPV["CAPEX_sys"] * CAPEX - NPV) / CAPEX**2
+
+    # Derivatives of the yearly hydrogen cost
+    # h2_p = efficiency_p*e_p + 9*w_p/997 + OPEX*efficiency_p/E_year
+    dh2_defficiency_p = e + OPEX/E_year
+    dh2_dE_year = -OPEX * efficiency_p / E_year**2
+    dh2 = {"efficiency": dh2_defficiency_p * efficiency_p / \
+                         expand(schedule["initial efficiency"]),
+           "efficiency_reduction_rate": dh2_defficiency_p * \
+                                        defficiency_p_dg * dg_dd,
+           "CAPEX_sys": expand(schedule["OPEX fraction"]) * efficiency_p / \
+                        E_year,
+           "E_o": dh2_dE_year * u * HOURS_PER_YEAR + \
+                  dOPEX_dE_o * efficiency_p / E_year,
+           "rate_of_use": dh2_dE_year * E_o * HOURS_PER_YEAR + \
+                          dh2_defficiency_p * defficiency_p_dg * dg_du,
+           "E_cost_scale": efficiency_p * energy_cost,
+           "hydrogen_price_scale": np.zeros_like(efficiency_p),
+           "water_price_scale": 9*water_cost/997 * np.ones_like(efficiency_p)}
+
+    years = schedule["lifetime years"] + 2
+    dLCOH = {name: np.sum(values, axis=-1, where=active) / years
+             for name, values in dh2.items()}
+    dLCOH["discount_rate"] = np.zeros(CAPEX.shape)
+    dLCOH["lifetime"] = np.zeros(CAPEX.shape)
+
+    return {metric: {name: gradients[name] for name in GRADIENT_INPUTS}
+            for metric, gradients in (("NPV", dNPV),
+                                      ("ROI", dROI),
+                                      ("LCOH", dLCOH))}
+
+
+def profitability_batch(
+    efficiency:Union[float, np.ndarray],
+    efficiency_reduction_rate:Union[float, np.ndarray],
+    CAPEX_sys:Union[float, np.ndarray],
+    lifetime:Union[float, np.ndarray],
+    E_o:Union[float, np.ndarray],
+    electrolyser_type: str,
+    rate_of_use:Union[float, np.ndarray],
+    discount_rate:Union[float, np.ndarray],
+    E_cost: Callable,
+    hydrogen_price:Callable,
+    water_price:Callable,
+    E_cost_scale:Union[float, np.ndarray] = 1.0,
+    hydrogen_price_scale:Union[float, np.ndarray] = 1.0,
+    water_price_scale:Union[float, np.ndarray] = 1.0,
+    metrics:Iterable[str] = ("NPV", "ROI", "payback", "LCOH"),
+    gradients:bool = False
+    )->dict:
+    """
+    Broadcast version of `calculate_profitability_metrics`: every numeric
+    input can be an array and all the combinations are evaluated at once.
+
+    The year axis is padded to the longest lifetime and the years after the
+    end of life of each case are masked out.
+
+    Arguments:
+    ----------
+    Same as `calculate_profitability_V3` (arrays allowed), plus
+
+    E_cost_scale, hydrogen_price_scale, water_price_scale: float or array ->
+        Multipliers of the price curves, used to sweep price levels.
+
+    metrics: Iterable[str] -> Any of BATCH_METRICS. The payback year is 0 when
+        the investment is never recovered, and the IRR is solved
+        iteratively, so it is only computed when requested.
+
+    gradients: bool -> Also return the derivatives of the NPV, ROI and LCOH
+        with respect to the GRADIENT_INPUTS (see `batch_gradients`) under
+        "gradients".
+
+    Returns:
+    -------
+    dict -> Requested metrics as arrays with the broadcast shape of the inputs.
+    """
+    metrics = set(metrics)
+    unknown = metrics.difference(BATCH_METRICS)
+    if unknown:
+        raise ValueError("Unknown batch metrics: {}".format(sorted(unknown)))
+
+    # Step 1: Broadcast all the inputs to the shape of the results
+    (efficiency, efficiency_reduction_rate, CAPEX_sys, lifetime, E_o,
+     rate_of_use, discount_rate, E_cost_scale, hydrogen_price_scale,
+     water_price_scale) = np.broadcast_arrays(
+                            *[np.asarray(x, dtype=float) for x in
+                              (efficiency, efficiency_reduction_rate,
+                               CAPEX_sys, lifetime, E_o, rate_of_use,
+                               discount_rate, E_cost_scale,
+                               hydrogen_price_scale, water_price_scale)])
+
+    # Step 2: Get the operating schedule and the prices of every year
+    schedule = operating_schedule(efficiency,
+                                  efficiency_reduction_rate,
+                                  CAPEX_sys,
+                                  lifetime,
+                                  E_o,
+                                  electrolyser_type,
+                                  rate_of_use)
+    energy_cost = price_schedule(schedule["years"], E_cost, E_cost_scale)
+    water_cost = price_schedule(schedule["years"], water_price,
+                                water_price_scale)
+
+    results = {}
+
+    if gradients:
+        results["gradients"] = batch_gradients(
+                            schedule,
+                            price_schedule(schedule["years"], E_cost),
+                            price_schedule(schedule["years"], hydrogen_price),
+                            price_schedule(schedule["years"], water_price),
+                            discount_rate,
+                            E_cost_scale,
+                            hydrogen_price_scale,
+                            water_price_scale)
+
+    if "LCOH" in metrics:
+        results["LCOH"] = batch_h2_cost(schedule, energy_cost, water_cost)
+
+    if not metrics.difference({"LCOH"}):
+        return results
+
+    # Step 3: Calculate the cash flows and the requested metrics
+    cash_flow_arr = batch_cash_flows(schedule,
+                                     energy_cost,
+                                     price_schedule(schedule["years"],
+                                                    hydrogen_price,
+                                                    hydrogen_price_scale),
+                                     water_cost)
+
+    if "IRR" in metrics:
+        results["IRR"] = batch_irr(schedule, cash_flow_arr)
+
+    if metrics.intersection({"NPV", "ROI", "payback"}):
+        results.update(batch_return_metrics(
+                                    schedule,
+                                    batch_cumulative_return(schedule,
+                                                            cash_flow_arr,
+                                                            discount_rate),
+                                    metrics))
+
+    return results
+
+
+def batch_blocks(n_cases:int,
+                 electrolyser_type:str,
+                 max_lifetime:float,
+                 min_rate_of_use:float,
+                 samples:int = 1,
+                 max_elements:int = 4_000_000) -> Iterator[slice]:
+    """
+    Blocks of cases to evaluate with `profitability_batch`, so that the
+    (cases, samples, years) arrays of a block stay below `max_elements`. The
+    longest lifetime [thousands of hours] at the lowest rate of use bounds
+    the year axis.
+    """
+    max_years = get_cost_model(electrolyser_type).lifetime_years(
+                                        max_lifetime, min_rate_of_use) + 2
+    block_size = max(1, max_elements // (samples * max_years))
+    for start in range(0, n_cases, block_size):
+        yield slice(start, min(start + block_size, n_cases))
+
+
+def sample_mean(values:np.ndarray, axis:int = -1) -> np.ndarray:
+    """
+    Mean of the samples along an axis, ignoring the NaN samples (an IRR
+    without root). A row without valid samples gives NaN.
+    """
+    values = np.asarray(values, dtype=float)
+    if not np.isnan(values).any():
+        return np.mean(values, axis=axis)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(values, axis=axis)
+
+
+def sample_quantile(values:np.ndarray, q:Union[float, Sequence[float]],
+                    axis:int = -1) -> np.ndarray:
+    """
+    Quantiles of the samples along an axis, ignoring the NaN samples (an IRR
+    without root). np.nanquantile works row by row, so it is only used when
+    there are NaNs. A row without valid samples gives NaN.
+    """
+    values = np.asarray(values, dtype=float)
+    if not np.isnan(values).any():
+        return np.quantile(values, q, axis=axis)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanquantile(values, q, axis=axis)
 
 
 @np.vectorize
@@ -0,0 +1,195 @@
+import numpy as np
+import plotly.graph_objects as go
+from typing import *
+
+from functions import profitability_batch, batch_blocks, sample_mean,\
+                      sample_quantile
+
+# Inputs of the profitability model that can be swept, with their labels.
+# The capital cost is given per kW so it follows the plant size.
+SWEEP_INPUTS = {
+    "efficiency": "Efficiency [kWh/KgH2]",
+    "efficiency_reduction_rate": "Efficiency decrease rate [1/ten thousand hours]",
+    "capital_cost": "Capital cost [USD/kW]",
+    "lifetime": "Lifetime [thousands of hours]",
+    "E_o": "Power output [kW]",
+    "rate_of_use": "Rate of use",
+    "discount_rate": "Discount rate",
+    "E_cost_scale": "Energy cost level [x projection]",
+    "hydrogen_price_scale": "Hydrogen price level [x projection]",
+    "water_price_scale": "Water price level [x projection]",
+}
+
+SWEEP_DEFAULTS = {
+    "efficiency_reduction_rate": 0.0,
+    "E_cost_scale": 1.0,
+    "hydrogen_price_scale": 1.0,
+    "water_price_scale": 1.0,
+}
+
+
+def sample_inputs(n:int,
+                  distributions:Dict[str, Tuple[float, float, float]],
+                  seed:Optional[int] = None) -> Dict[str, np.ndarray]:
+    """
+    Draws a shared sample set from triangular distributions.
+
+    Arguments:
+    ---------
+    n: int -> Number of samples
+
+    distributions: dict -> {input name: (left, mode, right)}
+
+    seed: int -> Seed of the random generator
+
+    Returns:
+    -------
+    dict -> {input name: samples}
+    """
+    rng = np.random.default_rng(seed)
+    return {name: rng.triangular(left, mode, right, n)
+            for name, (left, mode, right) in distributions.items()}
+
+
+def grid_sweep(electrolyser_type:str,
+               base_inputs:Dict[str, float],
+               axes:Dict[str, np.ndarray],
+               E_cost:Callable,
+               hydrogen_price:Callable,
+               water_price:Callable,
+               samples:Optional[Dict[str, np.ndarray]] = None,
+               metrics:Iterable[str] = ("NPV", "ROI", "LCOH"),
+               quantiles:Iterable[float] = (0.1, 0.9),
+               max_elements:int = 4_000_000,
+               )->Dict[str, Dict[str, np.ndarray]]:
+    """
+    Evaluates the profitability model over a grid of inputs.
+
+    Every cell of the grid is evaluated with the same sample set (if any), so
+    the differences between cells are not blurred by sampling noise.
+
+    Arguments:
+    ---------
+    electrolyser_type: str -> Electrolyser type
+
+    base_inputs: dict -> Value of the inputs that are neither swept nor
+        sampled (see SWEEP_INPUTS)
+
+    axes: dict -> {input name: grid values}, one grid dimension per input
+
+    E_cost, hydrogen_price, water_price: Callable -> Price curves by year
+
+    samples: dict -> {input name: samples} evaluated in every cell, None for
+        a deterministic sweep. A swept input overrides its samples.
+
+    metrics: Iterable[str] -> Metrics of `profitability_batch`
+
+    quantiles: Iterable[float] -> Quantiles reported per cell (e.g. 0.1 is
+        reported as "P10")
+
+    max_elements: int -> Maximum size of the (cells, samples, years) block
+        evaluated at once
+
+    Returns:
+    -------
+    dict -> {metric: {"mean" or "P<q>": array with the grid shape}}
+    """
+    unknown = set(axes).union(base_inputs, samples or {}).difference(
+                                                                SWEEP_INPUTS)
+    if unknown:
+        raise ValueError("Unknown sweep inputs: {}".format(sorted(unknown)))
+
+    metrics = tuple(metrics)
+    samples = {name: np.asarray(values, dtype=float)
+               for name, values in (samples or {}).items()
+               if name not in axes}
+    n_samples = len(next(iter(samples.values()))) if samples else 1
+
+    shape = tuple(len(values) for values in axes.values())
+    grid = np.meshgrid(*[np.asarray(values, dtype=float)
+                         for values in axes.values()], indexing="ij")
+    cells = {name: values.ravel()[:, None]
+             for name, values in zip(axes, grid)}
+
+    inputs = dict(SWEEP_DEFAULTS)
+    inputs.update(base_inputs)
+    inputs.update({name: values[None, :] for name, values in samples.items()})
+    missing = set(SWEEP_INPUTS).difference(inputs, cells)
+    if missing:
+        raise ValueError("Missing sweep inputs: {}".format(sorted(missing)))
+
+    # Extreme swept, sampled or base value of an input, for the block size
+    def extreme(name, reduce):
+        values = cells.get(name, inputs.get(name))
+        return reduce(np.asarray(values))
+
+    n_cells = int(np.prod(shape))
+    stats = ["mean"] + ["P{:g}".format(q*100) for q in quantiles]
+    results = {metric: {stat: np.empty(n_cells) for stat in stats}
+               for metric in metrics}
+
+    for block in batch_blocks(n_cells,
+                              electrolyser_type,
+                              extreme("lifetime", np.max),
+                              extreme("rate_of_use", np.min),
+                              n_samples,
+                              max_elements):
+        block_inputs = dict(inputs)
+        block_inputs.update({name: values[block]
+                             for name, values in cells.items()})
+
+        E_o = block_inputs["E_o"]
+        block_results = profitability_batch(
+                                block_inputs["efficiency"],
+                                block_inputs["efficiency_reduction_rate"],
+                                block_inputs["capital_cost"] * E_o,
+                                block_inputs["lifetime"],
+                                E_o,
+                                electrolyser_type,
+                                block_inputs["rate_of_use"],
+                                block_inputs["discount_rate"],
+                                E_cost,
+                                hydrogen_price,
+                                water_price,
+                                E_cost_scale=block_inputs["E_cost_scale"],
+                                hydrogen_price_scale=block_inputs[
+                                                    "hydrogen_price_scale"],
+                                water_price_scale=block_inputs[
+                                                    "water_price_scale"],
+                                metrics=metrics)
+
+        for metric in metrics:
+            values = np.broadcast_to(block_results[metric],
+                                     (block.stop - block.start, n_samples))
+            results[metric]["mean"][block] = sample_mean(values, axis=1)
+            for q, stat in zip(quantiles, stats[1:]):
+                results[metric][stat][block] = sample_quantile(values, q,
+                                                               axis=1)
+
+    return {metric: {stat: values.reshape(shape)
+                     for stat, values in metric_results.items()}
+            for metric, metric_results in results.items()}
+
+
+def sweep_heatmap(values:np.ndarray,
+                  x_values:np.ndarray,
+                  y_values:np.ndarray,
+                  x_title:str,
+                  y_title:str,
+                  title:str) -> go.Figure:
+    """
+    Heatmap with contour lines of a 2-D sweep result, the first grid axis is
+    plotted on the x axis.
+    """
+    chart = go.Figure()
+    chart.add_trace(go.Heatmap(x=x_values, y=y_values, z=values.T,
+                               colorscale="Viridis"))
+    chart.add_trace(go.Contour(x=x_values, y=y_values, z=values.T,
+                               showscale=False,
+                               contours=dict(coloring="lines",
+                                             showlabels=True),
+                               line=dict(color="white")))
+    chart.update_layout(title=title,
+                        xaxis_title=x_title,
+                        yaxis_title=y_title)
+    return chart
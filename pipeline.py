@@ -0,0 +1,300 @@
+from collections import OrderedDict
+import numpy as np
+from scipy import interpolate
+from typing import *
+
+from functions import operating_schedule, price_schedule, batch_h2_cost,\
+                      batch_cash_flows, batch_irr, batch_cumulative_return,\
+                      batch_return_metrics, batch_gradients
+from variance_reduction import ESTIMATORS, ESTIMATED_METRICS,\
+                               antithetic_uniforms, triangular_ppf,\
+                               expected_cash_flow, mode_linearization,\
+                               linear_control, controlled_mean
+
+# Sampled inputs of the Monte Carlo simulation, each one is drawn from its
+# own triangular distribution (left, mode, right).
+SAMPLED_INPUTS = ("efficiency", "lifetime", "CAPEX_sys")
+
+
+class SimulationPipeline:
+    """
+    Monte Carlo simulation of the profitability model as a graph of cached
+    stages:
+
+        samples -> operating schedule -> price lookup -> cash flows
+                -> discounting -> metrics
+
+    Every stage is keyed by its own inputs and by the keys of the stages it
+    depends on, so when only some inputs change only the stages downstream
+    of them are recomputed. For example, a new discount rate only recomputes
+    the discounting and the NPV, ROI and payback year, while the samples,
+    cash flows, IRR and hydrogen cost are reused.
+
+    Arguments:
+    ---------
+    seed: int -> Seed of the samples, so that changing the distribution of
+        one input does not resample the others.
+    """
+
+    def __init__(self, seed:Optional[int] = None):
+        self.seed = np.random.SeedSequence(seed).entropy
+        self._cache = {}
+        # Stages recomputed by the last run
+        self.recomputed = []
+
+    def _stage(self, name:str, key:tuple, compute:Callable) -> Tuple[tuple, Any]:
+        """
+        Returns the cached value of the stage if its key did not change,
+        otherwise recomputes it. The key is returned so that the stages that
+        depend on this one can include it in their own keys.
+        """
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, compute())
+            self._cache[name] = cached
+            self.recomputed.append(name)
+        return cached
+
+    def _samples(self, n:int, name:str,
+                 distribution:Tuple[float, float, float],
+                 antithetic:bool = False) -> Tuple[tuple, Any]:
+
+        def compute():
+            rng = np.random.default_rng(
+                            [self.seed, SAMPLED_INPUTS.index(name)])
+            if antithetic:
+                return triangular_ppf(antithetic_uniforms(rng, n),
+                                      *distribution)
+            return rng.triangular(*distribution, n)
+
+        return self._stage("samples " + name,
+                           (n, tuple(distribution), antithetic),
+                           compute)
+
+    def _prices(self, name:str, years:np.ndarray,
+                control_points:Tuple[Sequence, Sequence, str]
+                ) -> Tuple[tuple, Any]:
+
+        control_years, values, kind = control_points
+        key = (tuple(years), tuple(control_years), tuple(values), kind)
+
+        def compute():
+            return price_schedule(years, price_curve(control_points))
+
+        return self._stage("prices " + name, key, compute)
+
+    def run(self,
+            n:int,
+            distributions:Dict[str, Tuple[float, float, float]],
+            efficiency_reduction_rate:float,
+            E_o:float,
+            electrolyser_type:str,
+            rate_of_use:float,
+            discount_rate:float,
+            E_cost:Tuple[Sequence, Sequence, str],
+            hydrogen_price:Tuple[Sequence, Sequence, str],
+            water_price:Tuple[Sequence, Sequence, str],
+            gradients:bool = False,
+            estimator:str = "plain",
+            )->dict:
+        """
+        Runs the Monte Carlo simulation, reusing the stages whose inputs did
+        not change since the last run.
+
+        Arguments:
+        ---------
+        n: int -> Number of Monte Carlo samples
+
+        distributions: dict -> (left, mode, right) of every SAMPLED_INPUTS
+
+        efficiency_reduction_rate: float -> Efficiency reduction rate per ten
+            thousand hours
+
+        E_o: float -> Operating energy of the electrolyser (kW)
+
+        electrolyser_type: str -> Electrolyser type
+
+        rate_of_use: float -> Fraction of the day the electrolyser is used
+
+        discount_rate: float -> Discount rate
+
+        E_cost, hydrogen_price, water_price: tuple -> (years, values,
+            interpolation kind) control points of the price curves
+
+        gradients: bool -> Also return the derivatives of the NPV, ROI and
+            LCOH of every sample (see `batch_gradients`)
+
+        estimator: str -> Estimator of the mean ROI, NPV and LCOH, one of
+            ESTIMATORS (see variance_reduction.py). The antithetic
+            estimators draw 2*ceil(n/2) samples.
+
+        Returns:
+        -------
+        dict -> Per sample ROI, IRR, NPV, payback, LCOH, sampled inputs,
+            lifetime years, "estimates" of the mean ROI, NPV and LCOH (see
+            `controlled_mean`) and, if requested, gradients.
+        """
+        if estimator not in ESTIMATORS:
+            raise ValueError("Unknown estimator: {}".format(estimator))
+        antithetic = estimator.startswith("antithetic")
+        self.recomputed = []
+
+        samples = {name: self._samples(n, name, distributions[name],
+                                       antithetic)
+                   for name in SAMPLED_INPUTS}
+        samples_key = tuple(key for key, _ in samples.values())
+
+        schedule_key, schedule = self._stage(
+                "schedule",
+                (samples_key, efficiency_reduction_rate, E_o,
+                 electrolyser_type, rate_of_use),
+                lambda: operating_schedule(samples["efficiency"][1],
+                                           efficiency_reduction_rate,
+                                           samples["CAPEX_sys"][1],
+                                           samples["lifetime"][1],
+                                           E_o,
+                                           electrolyser_type,
+                                           rate_of_use))
+
+        years = schedule["years"]
+        E_cost_key, energy_cost = self._prices("E_cost", years, E_cost)
+        H2_key, H2_price = self._prices("hydrogen_price", years,
+                                        hydrogen_price)
+        water_key, water_cost = self._prices("water_price", years,
+                                             water_price)
+
+        LCOH_key, LCOH = self._stage(
+                "LCOH",
+                (schedule_key, E_cost_key, water_key),
+                lambda: batch_h2_cost(schedule, energy_cost, water_cost))
+
+        cash_flows_key, cash_flow_arr = self._stage(
+                "cash flows",
+                (schedule_key, E_cost_key, H2_key, water_key),
+                lambda: batch_cash_flows(schedule, energy_cost, H2_price,
+                                         water_cost))
+
+        _, IRR = self._stage(
+                "IRR",
+                cash_flows_key,
+                lambda: batch_irr(schedule, cash_flow_arr))
+
+        discounting_key, cumulative_return = self._stage(
+                "discounting",
+                (cash_flows_key, discount_rate),
+                lambda: batch_cumulative_return(schedule, cash_flow_arr,
+                                                discount_rate))
+
+        _, return_metrics = self._stage(
+                "metrics",
+                discounting_key,
+                lambda: batch_return_metrics(schedule, cumulative_return))
+
+        if gradients:
+            _, sample_gradients = self._stage(
+                "gradients",
+                (cash_flows_key, discount_rate),
+                lambda: batch_gradients(schedule, energy_cost, H2_price,
+                                        water_cost, discount_rate))
+
+        def compute_estimates():
+            values = {"LCOH": LCOH}
+            values.update(return_metrics)
+            if not estimator.endswith("control variates"):
+                return {metric: controlled_mean(values[metric],
+                                                antithetic=antithetic)
+                        for metric in ESTIMATED_METRICS}
+
+            # Controls: expansion of the metric at the modes and the
+            # undiscounted total cash flow
+            curves = [price_curve(points) for points in
+                      (E_cost, hydrogen_price, water_price)]
+            derivatives = mode_linearization(distributions,
+                                             efficiency_reduction_rate,
+                                             E_o,
+                                             electrolyser_type,
+                                             rate_of_use,
+                                             discount_rate,
+                                             *curves)
+            total_cash_flow = np.sum(cash_flow_arr, axis=-1)
+            expected_total = expected_cash_flow(distributions,
+                                                efficiency_reduction_rate,
+                                                E_o,
+                                                electrolyser_type,
+                                                rate_of_use,
+                                                *curves)
+            sampled = {name: sample_values for name, (_, sample_values) in
+                       samples.items()}
+            return {metric: controlled_mean(
+                                values[metric],
+                                np.column_stack([
+                                        linear_control(sampled,
+                                                       derivatives[metric],
+                                                       distributions),
+                                        total_cash_flow]),
+                                [0.0, expected_total],
+                                antithetic)
+                    for metric in ESTIMATED_METRICS}
+
+        _, estimates = self._stage(
+                "estimates",
+                (discounting_key, LCOH_key, estimator),
+                compute_estimates)
+
+        results = {"IRR": IRR,
+                   "LCOH": LCOH,
+                   "lifetime years": schedule["lifetime years"],
+                   "estimates": estimates}
+        results.update(return_metrics)
+        results.update({name: values for name, (_, values) in samples.items()})
+        if gradients:
+            results["gradients"] = sample_gradients
+        return results
+
+
+def price_curve(control_points:Tuple[Sequence, Sequence, str]) -> Callable:
+    """
+    Price curve by year from its (years, values, interpolation kind) control
+    points.
+    """
+    control_years, values, kind = control_points
+    return interpolate.interp1d(control_years, values, kind=kind,
+                                fill_value="extrapolate")
+
+
+# Seed of the simulations run by the compute service, shared by all the
+# sessions so that identical studies give identical requests.
+SIMULATION_SEED = 2022
+
+# Pipelines of the current (worker) process, by session and seed, the least
+# recently used are dropped
+MAX_PIPELINES = 16
+_pipelines = OrderedDict()
+
+
+def run_simulation(request:dict, session_id:Hashable = None) -> dict:
+    """
+    Runs a simulation request with the pipeline of the session in the current
+    process. The compute service sends the requests of a session to the same
+    worker, so consecutive requests reuse the cached stages.
+
+    Arguments:
+    ---------
+    request: dict -> Keyword arguments of `SimulationPipeline.run`, plus an
+        optional "seed" (SIMULATION_SEED by default)
+
+    session_id: Hashable -> Session of the request, sessions sharing a worker
+        do not overwrite the stages of each other
+
+    Returns:
+    -------
+    dict -> Results of `SimulationPipeline.run`
+    """
+    request = dict(request)
+    seed = request.pop("seed", SIMULATION_SEED)
+    key = (session_id, seed)
+    pipeline = _pipelines.pop(key, None) or SimulationPipeline(seed)
+    _pipelines[key] = pipeline
+    while len(_pipelines) > MAX_PIPELINES:
+        _pipelines.popitem(last=False)
+    return pipeline.run(**request)
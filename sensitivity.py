@@ -0,0 +1,120 @@
+import numpy as np
+from typing import *
+
+from functions import profitability_batch, GRADIENT_INPUTS
+
+# Local sensitivity of the profitability model from the analytic gradients
+# of `batch_gradients`, computed in the same pass as the metrics.
+
+SENSITIVITY_COLUMNS = ("input", "mean derivative", "mean elasticity",
+                       "elasticity P10", "elasticity P50", "elasticity P90")
+
+
+def elasticities(gradients:Dict[str, np.ndarray],
+                 inputs:Dict[str, Union[float, np.ndarray]],
+                 values:np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Elasticities (relative change of the metric per relative change of the
+    input) of every sample.
+
+    Arguments:
+    ---------
+    gradients: dict -> {input: derivative of the metric by sample}
+
+    inputs: dict -> {input: value of the input (scalar or by sample)}
+
+    values: np.ndarray -> Value of the metric by sample
+
+    Returns:
+    -------
+    dict -> {input: elasticity by sample}, NaN where the metric is zero
+    """
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {name: np.where(values != 0,
+                               gradients[name] * np.asarray(inputs[name]) / \
+                               values,
+                               np.nan)
+                for name in inputs}
+
+
+def sensitivity_report(gradients:Dict[str, np.ndarray],
+                       inputs:Dict[str, Union[float, np.ndarray]],
+                       values:np.ndarray) -> List[tuple]:
+    """
+    Local sensitivity report of one metric: mean derivative and distribution
+    of the elasticity of every input, sorted by mean absolute elasticity.
+
+    Returns:
+    -------
+    list -> Rows of SENSITIVITY_COLUMNS
+    """
+    input_elasticities = elasticities(gradients, inputs, values)
+
+    rows = []
+    for name, elasticity in input_elasticities.items():
+        elasticity = elasticity[~np.isnan(elasticity)]
+        quantiles = np.quantile(elasticity, [0.1, 0.5, 0.9]) \
+                    if elasticity.size else [np.nan]*3
+        rows.append((name,
+                     np.mean(gradients[name]),
+                     np.mean(elasticity) if elasticity.size else np.nan,
+                     *quantiles))
+
+    return sorted(rows, key=lambda row: -np.nan_to_num(abs(row[2])))
+
+
+def mean_npv_objective(names:Sequence[str],
+                       base_inputs:Dict[str, Union[float, np.ndarray]],
+                       electrolyser_type:str,
+                       E_cost:Callable,
+                       hydrogen_price:Callable,
+                       water_price:Callable
+                       ) -> Callable[[np.ndarray], Tuple[float, np.ndarray]]:
+    """
+    Objective for gradient-based optimizers (e.g. scipy.optimize.minimize
+    with jac=True): minus the mean NPV over the samples of `base_inputs`, and
+    its gradient with respect to the inputs in `names`.
+
+    Arguments:
+    ---------
+    names: Sequence[str] -> Optimized inputs (of GRADIENT_INPUTS)
+
+    base_inputs: dict -> Value of every GRADIENT_INPUTS (scalar or samples)
+
+    electrolyser_type: str -> Electrolyser type
+
+    E_cost, hydrogen_price, water_price: Callable -> Price curves by year
+
+    Returns:
+    -------
+    Callable -> x -> (-mean NPV, -gradient)
+    """
+    unknown = set(names).difference(GRADIENT_INPUTS)
+    if unknown:
+        raise ValueError("Unknown gradient inputs: {}".format(sorted(unknown)))
+
+    def objective(x:np.ndarray) -> Tuple[float, np.ndarray]:
+        inputs = dict(base_inputs)
+        inputs.update(zip(names, x))
+        results = profitability_batch(inputs["efficiency"],
+                                      inputs["efficiency_reduction_rate"],
+                                      inputs["CAPEX_sys"],
+                                      inputs["lifetime"],
+                                      inputs["E_o"],
+                                      electrolyser_type,
+                                      inputs["rate_of_use"],
+                                      inputs["discount_rate"],
+                                      E_cost,
+                                      hydrogen_price,
+                                      water_price,
+                                      inputs["E_cost_scale"],
+                                      inputs["hydrogen_price_scale"],
+                                      inputs["water_price_scale"],
+                                      metrics=("NPV",),
+                                      gradients=True)
+        gradients = results["gradients"]["NPV"]
+        return -np.mean(results["NPV"]), \
+               -np.array([np.mean(gradients[name]) for name in names])
+
+    return objective
@@ -0,0 +1,248 @@
+import re
+import numpy as np
+from scipy import interpolate
+from typing import *
+
+from functions import profitability_batch, get_cost_model, batch_blocks,\
+                      BATCH_METRICS
+
+# Deterministic screening of candidate sites.
+# Every site of a table (one column array per input) is evaluated at the
+# mode values of the triangular distributions of the electrolyser with one
+# broadcast `profitability_batch` call per block of sites, before any Monte
+# Carlo simulation of the shortlisted sites.
+
+# Columns of a sites table. "E_o" and "rate_of_use" are required, the other
+# inputs fall back to the arguments of `screen_sites`.
+SITE_INPUTS = {
+    "E_o": "Power output [kW]",
+    "rate_of_use": "Rate of use",
+    "discount_rate": "Discount rate",
+    "efficiency_reduction_rate": "Efficiency decrease rate [1/ten thousand hours]",
+}
+
+# Price columns: a constant level per site ("E_cost") or control points of a
+# curve per site, one column per year ("E_cost_2022", "E_cost_2030", ...)
+SITE_PRICES = {
+    "E_cost": "Energy cost [USD/kWh]",
+    "hydrogen_price": "Hydrogen price [USD/kg]",
+    "water_price": "Water price [USD/m3]",
+}
+
+# Metrics where the best sites have the lowest values
+ASCENDING_METRICS = ("payback", "LCOH")
+
+
+def load_sites(source:Union[str, IO], file_format:Optional[str] = None
+               ) -> Dict[str, np.ndarray]:
+    """
+    Loads a sites table as column arrays.
+
+    Arguments:
+    ---------
+    source: str or file -> CSV file with a header row, or NPZ file with one
+        array per column
+
+    file_format: str -> "csv" or "npz", taken from the file name by default
+
+    Returns:
+    -------
+    dict -> {column: array}
+    """
+    name = source if isinstance(source, str) else getattr(source, "name", "")
+    file_format = file_format or name.rsplit(".", 1)[-1].lower()
+
+    if file_format == "npz":
+        with np.load(source) as data:
+            return {column: data[column] for column in data.files}
+    if file_format == "csv":
+        # A single row is read as a 0-d table
+        table = np.atleast_1d(np.genfromtxt(source, delimiter=",",
+                                            names=True, dtype=None,
+                                            encoding="utf-8",
+                                            deletechars=""))
+        return {column: table[column] for column in table.dtype.names}
+    raise ValueError("Unknown sites table format: {}".format(file_format))
+
+
+def site_price_curve(sites:Dict[str, np.ndarray], name:str,
+                     default:Callable, kind:str = "linear") -> Callable:
+    """
+    Price curve of every site: the per year columns of the price
+    (`<name>_<year>`) interpolated between the years, its constant level
+    column (`<name>`), or the `default` curve shared by all the sites.
+
+    Returns:
+    -------
+    Callable -> years -> (sites, years) prices
+    """
+    pattern = re.compile(r"^{}_(\d{{4}})$".format(re.escape(name)))
+    columns = sorted((int(match.group(1)), column) for column in sites
+                     for match in [pattern.match(column)] if match)
+
+    if len(columns) > 1:
+        return interpolate.interp1d([year for year, _ in columns],
+                                    np.stack([np.asarray(sites[column],
+                                                         dtype=float)
+                                              for _, column in columns],
+                                             axis=-1),
+                                    kind=kind,
+                                    axis=-1,
+                                    fill_value="extrapolate")
+    if columns:
+        level = np.asarray(sites[columns[0][1]], dtype=float)
+    elif name in sites:
+        level = np.asarray(sites[name], dtype=float)
+    else:
+        return default
+    return lambda years: level[:, None] * np.ones_like(years, dtype=float)
+
+
+def mode_inputs(electrolyser_type:str) -> Dict[str, float]:
+    """
+    Default mode values of the triangular distributions: the middle of the
+    IRENA ranges of the electrolyser type, as in the selector.
+
+    Returns:
+    -------
+    dict -> "efficiency" [kWh/KgH2], "lifetime" [thousands of hours] and
+        "capital_cost" [USD/kW]
+    """
+    ranges = get_cost_model(electrolyser_type).ranges
+    return {"efficiency": sum(ranges["efficiency"])/2,
+            "lifetime": sum(ranges["lifetime"])/2,
+            "capital_cost": sum(ranges["full system cost"])/2}
+
+
+def screen_sites(sites:Dict[str, np.ndarray],
+                 electrolyser_type:str,
+                 E_cost:Callable,
+                 hydrogen_price:Callable,
+                 water_price:Callable,
+                 discount_rate:float = 0.07,
+                 efficiency_reduction_rate:float = 0.0,
+                 modes:Optional[Dict[str, float]] = None,
+                 metrics:Iterable[str] = BATCH_METRICS,
+                 kind:str = "linear",
+                 max_elements:int = 4_000_000) -> Dict[str, np.ndarray]:
+    """
+    Evaluates every site of a table at the mode values of the electrolyser.
+
+    Arguments:
+    ---------
+    sites: dict -> Column arrays of the sites (see SITE_INPUTS and
+        SITE_PRICES), e.g. from `load_sites`
+
+    electrolyser_type: str -> Electrolyser type
+
+    E_cost, hydrogen_price, water_price: Callable -> Price curves by year of
+        the sites without price columns
+
+    discount_rate, efficiency_reduction_rate: float -> Values of the sites
+        without their column
+
+    modes: dict -> Mode values of "efficiency", "lifetime" and
+        "capital_cost" (per kW), `mode_inputs` by default
+
+    metrics: Iterable[str] -> Any of BATCH_METRICS. The IRR is solved
+        iteratively and dominates the run time.
+
+    kind: str -> Interpolation kind of the per year price columns
+
+    max_elements: int -> Maximum size of the (sites, years) block evaluated
+        at once
+
+    Returns:
+    -------
+    dict -> "site" (identifier column, or row index), "valid" (sites with a
+        positive power output, a rate of use in (0, 1] and finite inputs) and
+        the metric arrays by site, NaN for the invalid sites
+    """
+    missing = {"E_o", "rate_of_use"}.difference(sites)
+    if missing:
+        raise ValueError("Missing site columns: {}".format(sorted(missing)))
+
+    metrics = tuple(metrics)
+    modes = dict(mode_inputs(electrolyser_type), **(modes or {}))
+
+    inputs = {"discount_rate": discount_rate,
+              "efficiency_reduction_rate": efficiency_reduction_rate}
+    inputs.update({name: np.asarray(sites[name], dtype=float)
+                   for name in SITE_INPUTS if name in sites})
+    n_sites = len(inputs["E_o"])
+    inputs = {name: np.broadcast_to(values, (n_sites,))
+              for name, values in inputs.items()}
+
+    # Invalid rows are reported instead of stopping the screening
+    with np.errstate(invalid="ignore"):
+        valid = np.all([np.isfinite(values) for values in inputs.values()],
+                       axis=0) & (inputs["E_o"] > 0) & \
+                (inputs["rate_of_use"] > 0) & (inputs["rate_of_use"] <= 1)
+    valid_sites = np.flatnonzero(valid)
+
+    results = {metric: np.full(n_sites, np.nan) for metric in metrics}
+    results["site"] = sites["site"] if "site" in sites else np.arange(n_sites)
+    results["valid"] = valid
+    if not valid_sites.size:
+        return results
+
+    for positions in batch_blocks(valid_sites.size,
+                                  electrolyser_type,
+                                  modes["lifetime"],
+                                  np.min(inputs["rate_of_use"][valid]),
+                                  max_elements=max_elements):
+        block = valid_sites[positions]
+        block_sites = {column: values[block] for column, values in
+                       sites.items()}
+        E_o = inputs["E_o"][block]
+        block_results = profitability_batch(
+                            modes["efficiency"],
+                            inputs["efficiency_reduction_rate"][block],
+                            modes["capital_cost"] * E_o,
+                            modes["lifetime"],
+                            E_o,
+                            electrolyser_type,
+                            inputs["rate_of_use"][block],
+                            inputs["discount_rate"][block],
+                            site_price_curve(block_sites, "E_cost", E_cost,
+                                             kind),
+                            site_price_curve(block_sites, "hydrogen_price",
+                                             hydrogen_price, kind),
+                            site_price_curve(block_sites, "water_price",
+                                             water_price, kind),
+                            metrics=metrics)
+        for metric in metrics:
+            results[metric][block] = block_results[metric]
+
+    return results
+
+
+def shortlist(results:Dict[str, np.ndarray], metric:str = "NPV",
+              size:int = 100) -> np.ndarray:
+    """
+    Indices of the best valid sites by a metric, best first. Sites that
+    never recover the investment (payback 0) or without IRR (NaN) are ranked
+    last.
+
+    Arguments:
+    ---------
+    results: dict -> Results of `screen_sites`
+
+    metric: str -> Ranking metric
+
+    size: int -> Number of sites in the shortlist
+
+    Returns:
+    -------
+    np.ndarray -> Indices of the shortlisted sites
+    """
+    values = np.asarray(results[metric], dtype=float)
+    if metric == "payback":
+        values = np.where(values == 0, np.inf, values)
+    if metric not in ASCENDING_METRICS:
+        values = -values
+    # NaNs are sorted last
+    ranking = np.argsort(values, kind="stable")
+    if "valid" in results:
+        ranking = ranking[results["valid"][ranking]]
+    return ranking[:size]
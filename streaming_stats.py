@@ -0,0 +1,488 @@
+import numpy as np
+from scipy import stats
+from typing import *
+
+# Streaming estimators for the Monte Carlo results.
+# Every estimator is fed chunk by chunk with `update` and can be combined
+# with the estimator of another worker with `merge`, so the summary of a
+# simulation never needs to keep every sample in memory.
+
+
+class RunningMoments:
+    """
+    Running count, mean, variance, minimum and maximum (Welford's algorithm,
+    with Chan's formula to combine chunks and workers).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _combine(self, count:int, mean:float, M2:float,
+                 min_value:float, max_value:float):
+
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.M2 += M2 + delta**2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, min_value)
+        self.max = max(self.max, max_value)
+
+    def update(self, values:np.ndarray) -> "RunningMoments":
+        """
+        Adds a chunk of samples. NaN values are ignored.
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if values.size:
+            mean = values.mean()
+            self._combine(values.size, mean, np.sum((values - mean)**2),
+                          values.min(), values.max())
+        return self
+
+    def merge(self, other:"RunningMoments") -> "RunningMoments":
+        """
+        Adds the samples summarized by another estimator.
+        """
+        self._combine(other.count, other.mean, other.M2, other.min, other.max)
+        return self
+
+    @property
+    def variance(self) -> float:
+        return self.M2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def std(self) -> float:
+        return np.sqrt(self.variance)
+
+    @property
+    def standard_error(self) -> float:
+        """
+        Monte Carlo standard error of the mean.
+        """
+        return self.std / np.sqrt(self.count) if self.count > 1 else np.nan
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch.
+
+    Items are kept in compactors; an item stored at level h stands for 2**h
+    samples. When a compactor overflows, its sorted items are halved and
+    half of them are promoted to the next level. The memory used is
+    O(k log(n/k)) and the normalized rank error of the quantiles and of the
+    ECDF stays below `rank_error` (2.5/k**0.9) with high probability.
+
+    Arguments:
+    ---------
+    k: int -> Size of the largest compactor (accuracy parameter).
+
+    seed: int -> Seed of the random compaction offsets.
+    """
+
+    def __init__(self, k:int = 200, seed:Optional[int] = None):
+        self.k = k
+        self.count = 0
+        self.compactors = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def rank_error(self) -> float:
+        # Calibrated on the largest error over 999 quantiles of 10 to 30
+        # sketches of 1e5 to 1e6 samples fed in 1 to 10000 chunks, which
+        # reached 2.3/k**0.91 (k from 100 to 1000)
+        return 2.5 / self.k**0.9
+
+    def _capacity(self, level:int) -> int:
+        depth = len(self.compactors) - level - 1
+        return max(2, int(np.ceil(self.k * (2/3)**depth)))
+
+    def _compress(self):
+
+        compressed = False
+        while not compressed:
+            compressed = True
+            for level in range(len(self.compactors)):
+                items = self.compactors[level]
+                if items.size <= self._capacity(level):
+                    continue
+                compressed = False
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+
+                items = np.sort(items)
+                # An odd item stays at its level
+                leftover = items[items.size - items.size % 2:]
+                items = items[:items.size - items.size % 2]
+                promoted = items[self._rng.integers(2)::2]
+
+                self.compactors[level] = leftover
+                self.compactors[level + 1] = np.concatenate(
+                                        [self.compactors[level + 1], promoted])
+
+    def update(self, values:np.ndarray) -> "QuantileSketch":
+        """
+        Adds a chunk of samples. NaN values are ignored.
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.count += values.size
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other:"QuantileSketch") -> "QuantileSketch":
+        """
+        Adds the samples summarized by another sketch.
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate(
+                                                [self.compactors[level], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def weighted_items(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the sorted retained items and their weights.
+        """
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(c.size, 2.0**level)
+                                  for level, c in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        return items[order], weights[order]
+
+    def ecdf(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the approximate empirical cumulative distribution as
+        (values, cumulative fraction).
+        """
+        items, weights = self.weighted_items()
+        cumulative = np.cumsum(weights)
+        return items, cumulative / cumulative[-1] if items.size else cumulative
+
+    def quantile(self, q:Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        """
+        Returns the approximate q-quantile(s), with q in [0, 1].
+        """
+        items, fraction = self.ecdf()
+        if not items.size:
+            return np.full(np.shape(q), np.nan)[()]
+        index = np.searchsorted(fraction, np.asarray(q, dtype=float),
+                                side="left")
+        return items[np.minimum(index, items.size - 1)]
+
+    def cdf(self, x:Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        """
+        Returns the approximate fraction of samples lower or equal than x.
+        """
+        items, fraction = self.ecdf()
+        if not items.size:
+            return np.full(np.shape(x), np.nan)[()]
+        index = np.searchsorted(items, np.asarray(x, dtype=float),
+                                side="right")
+        return np.concatenate([[0.0], fraction])[index]
+
+
+class FixedHistogram:
+    """
+    Histogram with fixed bins, samples outside the range are counted in the
+    underflow and overflow counters.
+
+    Arguments:
+    ---------
+    lower: float -> Lower edge of the first bin.
+
+    upper: float -> Upper edge of the last bin.
+
+    bins: int -> Number of bins.
+    """
+
+    def __init__(self, lower:float, upper:float, bins:int = 100):
+        self.edges = np.linspace(lower, upper, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def update(self, values:np.ndarray) -> "FixedHistogram":
+        """
+        Adds a chunk of samples. NaN values are ignored.
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.counts += np.histogram(values, self.edges)[0]
+        self.underflow += int(np.sum(values < self.edges[0]))
+        self.overflow += int(np.sum(values > self.edges[-1]))
+        return self
+
+    def merge(self, other:"FixedHistogram") -> "FixedHistogram":
+        """
+        Adds the counts of a histogram with the same bins.
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Only histograms with the same bins can be merged")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def ecdf(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the cumulative fraction at the upper edge of every bin, exact
+        to within one bin width.
+        """
+        cumulative = self.underflow + np.cumsum(self.counts)
+        return self.edges[1:], cumulative / max(self.count, 1)
+
+
+class BootstrapMean:
+    """
+    Poisson bootstrap of the mean, fed chunk by chunk.
+
+    Every replicate gives each sample a Poisson(1) weight. Chunks of more
+    than `max_blocks` samples are split in `max_blocks` blocks of consecutive
+    samples weighted together: the Monte Carlo samples are independent, so
+    the block means are too, and with enough blocks the replicates keep the
+    spread of the sample-level bootstrap with far fewer random draws.
+
+    Arguments:
+    ---------
+    replicates: int -> Number of bootstrap replicates
+
+    max_blocks: int -> Maximum number of weights drawn per replicate and
+        chunk
+
+    seed: int -> Seed of the Poisson weights
+    """
+
+    def __init__(self, replicates:int = 2000, max_blocks:int = 1000,
+                 seed:Optional[int] = None):
+        self.max_blocks = max_blocks
+        self.sums = np.zeros(replicates)
+        self.counts = np.zeros(replicates)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values:np.ndarray) -> "BootstrapMean":
+        """
+        Adds a chunk of samples. NaN values are ignored.
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return self
+
+        block_size = -(-values.size // self.max_blocks)
+        starts = np.arange(0, values.size, block_size)
+        block_sums = np.add.reduceat(values, starts)
+        block_counts = np.diff(np.append(starts, values.size))
+
+        weights = self._rng.poisson(1.0, (self.sums.size, starts.size))
+        self.sums += weights @ block_sums
+        self.counts += weights @ block_counts
+        return self
+
+    def merge(self, other:"BootstrapMean") -> "BootstrapMean":
+        """
+        Adds the replicates of another estimator with the same number of
+        replicates.
+        """
+        self.sums += other.sums
+        self.counts += other.counts
+        return self
+
+    def replicates(self) -> np.ndarray:
+        """
+        Bootstrap replicates of the mean (replicates without weight are NaN).
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.counts
+
+    def ci(self, level:float = 0.95) -> Tuple[float, float]:
+        """
+        Percentile bootstrap confidence interval of the mean.
+        """
+        replicates = self.replicates()
+        replicates = replicates[~np.isnan(replicates)]
+        if not replicates.size:
+            return (np.nan, np.nan)
+        alpha = (1 - level)/2
+        return tuple(np.quantile(replicates, [alpha, 1 - alpha]))
+
+
+def pair_means(values:np.ndarray) -> np.ndarray:
+    """
+    Means of the antithetic pairs of a chunk, where the sample i is paired
+    with the sample i + len(values)/2. A pair with a NaN sample is NaN.
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    if values.size % 2:
+        raise ValueError("A chunk of antithetic pairs has an even size")
+    half = values.size // 2
+    return (values[:half] + values[half:]) / 2
+
+
+def quantile_ci(sketch:QuantileSketch, q:float,
+                level:float = 0.95) -> Tuple[float, float]:
+    """
+    Bootstrap confidence interval of the q-quantile.
+
+    In a bootstrap resample of n samples, the number of values below the
+    sample quantile of rank r is Binomial(n, r), so the percentile bootstrap
+    interval of the quantile is given by the binomial quantiles of the rank,
+    without resampling. The ranks are then read from the sketch, adding its
+    rank error to the interval.
+
+    The binomial ranks assume independent samples. With antithetic pairs the
+    two samples of a pair fall on opposite sides of the quantile more often
+    than independent ones for the metrics monotone in the sampled inputs, so
+    the interval is conservative (wider than needed), but it is not
+    guaranteed for the other metrics.
+    """
+    n = sketch.count
+    if not n:
+        return (np.nan, np.nan)
+    alpha = (1 - level)/2
+    ranks = stats.binom.ppf([alpha, 1 - alpha], n, q) / n + \
+            np.array([-1, 1]) * sketch.rank_error
+    return tuple(sketch.quantile(np.clip(ranks, 0, 1)))
+
+
+class MetricSummary:
+    """
+    Streaming summary (moments, quantile sketch and optionally a fixed
+    histogram) of one Monte Carlo metric.
+
+    Arguments:
+    ---------
+    k: int -> Accuracy parameter of the quantile sketch.
+
+    histogram_range: tuple -> (lower, upper) of the histogram, None to skip it.
+
+    bins: int -> Number of bins of the histogram.
+
+    replicates: int -> Number of bootstrap replicates of the mean.
+
+    paired: bool -> Every chunk holds antithetic pairs (see `pair_means`).
+        The bootstrap of the mean resamples the pair means, the independent
+        units, and leaves out the pairs with a NaN sample.
+    """
+
+    def __init__(self, k:int = 1000,
+                 histogram_range:Optional[Tuple[float, float]] = None,
+                 bins:int = 100,
+                 replicates:int = 2000,
+                 seed:Optional[int] = None,
+                 paired:bool = False):
+        self.paired = paired
+        self.moments = RunningMoments()
+        self.sketch = QuantileSketch(k, seed)
+        self.bootstrap = BootstrapMean(replicates, seed=seed)
+        self.histogram = None if histogram_range is None else \
+                         FixedHistogram(*histogram_range, bins)
+
+    def update(self, values:np.ndarray) -> "MetricSummary":
+        self.moments.update(values)
+        self.sketch.update(values)
+        self.bootstrap.update(pair_means(values) if self.paired else values)
+        if self.histogram is not None:
+            self.histogram.update(values)
+        return self
+
+    def merge(self, other:"MetricSummary") -> "MetricSummary":
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        self.bootstrap.merge(other.bootstrap)
+        if self.histogram is not None:
+            self.histogram.merge(other.histogram)
+        return self
+
+    @property
+    def mean(self) -> float:
+        return self.moments.mean if self.moments.count else np.nan
+
+    @property
+    def median(self) -> float:
+        return self.sketch.quantile(0.5)
+
+    def quantile(self, q:Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        return self.sketch.quantile(q)
+
+    def mean_ci(self, level:float = 0.95) -> Tuple[float, float]:
+        return self.bootstrap.ci(level)
+
+    def quantile_ci(self, q:float, level:float = 0.95) -> Tuple[float, float]:
+        return quantile_ci(self.sketch, q, level)
+
+    def ecdf(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.sketch.ecdf()
+
+
+SIMULATION_METRICS = ("ROI", "IRR", "NPV", "H2 cost", "payback")
+
+SUMMARY_COLUMNS = ("metric", "samples", "mean", "mean CI low", "mean CI high",
+                   "median", "median CI low", "median CI high")
+
+
+class SimulationSummary:
+    """
+    Streaming summary of the Monte Carlo metrics (ROI, IRR, NPV, H2 cost and
+    payback year by default).
+
+    Arguments:
+    ---------
+    metrics: Iterable[str] -> Names of the summarized metrics.
+
+    histogram_ranges: dict -> Optional (lower, upper) histogram range by metric.
+
+    k: int -> Accuracy parameter of the quantile sketches.
+
+    paired: bool -> The chunks hold antithetic pairs (see `MetricSummary`).
+    """
+
+    def __init__(self, metrics:Iterable[str] = SIMULATION_METRICS,
+                 histogram_ranges:Optional[Dict[str, tuple]] = None,
+                 k:int = 1000,
+                 seed:Optional[int] = None,
+                 paired:bool = False):
+        histogram_ranges = histogram_ranges or {}
+        self.metrics = {name: MetricSummary(k, histogram_ranges.get(name),
+                                            seed=seed, paired=paired)
+                        for name in metrics}
+
+    def __getitem__(self, name:str) -> MetricSummary:
+        return self.metrics[name]
+
+    def update(self, chunk:Dict[str, np.ndarray]) -> "SimulationSummary":
+        """
+        Adds a chunk of samples given as {metric name: values}.
+        """
+        for name, values in chunk.items():
+            self.metrics[name].update(values)
+        return self
+
+    def merge(self, other:"SimulationSummary") -> "SimulationSummary":
+        for name, summary in self.metrics.items():
+            summary.merge(other.metrics[name])
+        return self
+
+    def table(self, level:float = 0.95) -> List[tuple]:
+        """
+        Mean and median of every metric with their bootstrap confidence
+        intervals, as rows of SUMMARY_COLUMNS.
+        """
+        return [(name, summary.moments.count, summary.mean,
+                 *summary.mean_ci(level), summary.median,
+                 *summary.quantile_ci(0.5, level))
+                for name, summary in self.metrics.items()]
@@ -0,0 +1,479 @@
+import os
+import sys
+import json
+import hashlib
+import itertools
+import numpy as np
+from numpy.polynomial import legendre
+from scipy import interpolate
+from typing import *
+
+from functions import profitability_batch, get_cost_model, batch_blocks,\
+                      sample_quantile
+from variance_reduction import triangular_ppf
+
+# Surrogate of the Monte Carlo simulation.
+# A polynomial chaos expansion (Legendre polynomials of total degree
+# `degree` over the input box) is fitted to the quantiles of the ROI, IRR
+# and hydrogen cost simulated at random design points of the inputs of the
+# selector. Evaluating it takes microseconds, so the selector can show its
+# prediction at once and reconcile it with the Monte Carlo run afterwards.
+# The surrogate is stored with the hash of the parameter file it was
+# trained with, and a surrogate of another version is not loaded.
+
+PARAMS_FILE = "electrolyser_params.json"
+
+SURROGATE_DIRECTORY = "surrogates"
+
+# Inputs of the surrogate. The triangular distributions are given by their
+# (left, mode, right) values, the capital cost per kW, and the price curves
+# by their level relative to the base projections.
+TRIANGULAR_INPUTS = {"efficiency": "efficiency",
+                     "lifetime": "lifetime",
+                     "capital_cost": "full system cost"}
+
+SURROGATE_INPUTS = ("E_o", "rate_of_use", "discount_rate",
+                    "efficiency_reduction_rate") + \
+                   tuple("{}_{}".format(name, point)
+                         for name in TRIANGULAR_INPUTS
+                         for point in ("left", "mode", "right")) + \
+                   ("E_cost_level", "hydrogen_price_level",
+                    "water_price_level")
+
+# Training box of the inputs that do not depend on the electrolyser type
+SURROGATE_BOUNDS = {"E_o": (10000.0, 100000.0),
+                    "rate_of_use": (0.1, 1.0),
+                    "discount_rate": (0.0, 0.15),
+                    "efficiency_reduction_rate": (0.0, 0.05),
+                    "E_cost_level": (0.5, 2.0),
+                    "hydrogen_price_level": (0.5, 2.0),
+                    "water_price_level": (0.5, 2.0)}
+
+# Inputs scaled on a logarithmic axis, the metrics vary with their ratios
+LOG_INPUTS = ("E_o", "rate_of_use", "capital_cost_left", "capital_cost_mode",
+              "capital_cost_right", "E_cost_level", "hydrogen_price_level",
+              "water_price_level")
+
+# Simulated metrics (as in SIMULATION_METRICS, the IRR in %) and quantiles
+SURROGATE_METRICS = {"ROI": "ROI", "IRR": "IRR", "H2 cost": "LCOH"}
+SURROGATE_QUANTILES = (0.1, 0.5, 0.9)
+SURROGATE_OUTPUTS = tuple("{} P{:g}".format(metric, q*100)
+                          for metric in SURROGATE_METRICS
+                          for q in SURROGATE_QUANTILES)
+
+ERROR_COLUMNS = ("output", "RMSE", "MAE", "max error", "R2")
+
+
+def params_version(path:str = PARAMS_FILE) -> str:
+    """
+    Version of the parameter file: the first 12 characters of its SHA-256.
+    """
+    with open(path, "rb") as params_file:
+        return hashlib.sha256(params_file.read()).hexdigest()[:12]
+
+
+def surrogate_path(electrolyser_type:str,
+                   version:Optional[str] = None,
+                   directory:str = SURROGATE_DIRECTORY) -> str:
+    """
+    File of the surrogate of an electrolyser type for a parameter file
+    version (the current one by default).
+    """
+    return os.path.join(directory, "surrogate_{}_{}.npz".format(
+                                electrolyser_type, version or params_version()))
+
+
+def input_bounds(electrolyser_type:str) -> Dict[str, Tuple[float, float]]:
+    """
+    Training box of the SURROGATE_INPUTS, the triangular distributions span
+    the IRENA ranges of the electrolyser type.
+    """
+    ranges = get_cost_model(electrolyser_type).ranges
+    bounds = dict(SURROGATE_BOUNDS)
+    for name, range_name in TRIANGULAR_INPUTS.items():
+        for point in ("left", "mode", "right"):
+            bounds["{}_{}".format(name, point)] = ranges[range_name]
+    return {name: bounds[name] for name in SURROGATE_INPUTS}
+
+
+def price_level(control_points:Tuple[Sequence, Sequence, str],
+                base_points:Tuple[Sequence, Sequence, str]) -> float:
+    """
+    Level of a price curve relative to a base curve: ratio of their means
+    over the control years of the base curve.
+    """
+    years = np.asarray(base_points[0])
+    curve = interpolate.interp1d(control_points[0], control_points[1],
+                                 kind=control_points[2],
+                                 fill_value="extrapolate")
+    return float(np.mean(curve(years)) / np.mean(base_points[1]))
+
+
+def legendre_features(x:np.ndarray, exponents:np.ndarray) -> np.ndarray:
+    """
+    Products of Legendre polynomials of the scaled inputs.
+
+    Arguments:
+    ---------
+    x: np.ndarray -> (points, inputs) inputs scaled to [-1, 1]
+
+    exponents: np.ndarray -> (terms, inputs) degree of every input in every
+        term
+
+    Returns:
+    -------
+    np.ndarray -> (points, terms) features
+    """
+    x = np.atleast_2d(x)
+    values = legendre.legvander(x, exponents.max())
+    return np.prod(values[:, np.arange(x.shape[1]), exponents], axis=-1)
+
+
+def total_degree_exponents(n_inputs:int, degree:int) -> np.ndarray:
+    """
+    Exponents of all the terms of total degree up to `degree`.
+    """
+    exponents = []
+    for total in range(degree + 1):
+        for inputs in itertools.combinations_with_replacement(
+                                                    range(n_inputs), total):
+            exponents.append(np.bincount(inputs, minlength=n_inputs))
+    return np.array(exponents, dtype=int)
+
+
+class Surrogate:
+    """
+    Polynomial chaos surrogate of the SURROGATE_OUTPUTS of one electrolyser
+    type.
+
+    Arguments:
+    ---------
+    electrolyser_type: str -> Electrolyser type
+
+    bounds: dict -> Training box of the SURROGATE_INPUTS
+
+    exponents: np.ndarray -> (terms, inputs) exponents of the expansion
+
+    coefficients: np.ndarray -> (terms, outputs) coefficients
+
+    error_report: np.ndarray -> (outputs, 4) held-out RMSE, MAE, max error
+        and R2 of every output
+
+    base_prices: dict -> Control points of the base price curves
+
+    version: str -> Version of the parameter file of the training
+    """
+
+    def __init__(self, electrolyser_type:str,
+                 bounds:Dict[str, Tuple[float, float]],
+                 exponents:np.ndarray,
+                 coefficients:np.ndarray,
+                 error_report:np.ndarray,
+                 base_prices:Dict[str, Tuple[Sequence, Sequence, str]],
+                 version:str):
+        self.electrolyser_type = electrolyser_type
+        self.bounds = bounds
+        self.exponents = exponents
+        self.coefficients = coefficients
+        self.error_report = error_report
+        self.base_prices = base_prices
+        self.version = version
+
+    def scale(self, inputs:Dict[str, Union[float, np.ndarray]]) -> np.ndarray:
+        """
+        Scales the inputs to the [-1, 1] box of the training (LOG_INPUTS on
+        a logarithmic axis).
+        """
+        log_scaled = np.isin(SURROGATE_INPUTS, LOG_INPUTS)
+        low, high = np.array([self.bounds[name] for name in
+                              SURROGATE_INPUTS], dtype=float).T
+        values = np.column_stack([np.ravel(inputs[name]) for name in
+                                  SURROGATE_INPUTS]).astype(float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            low, high, values = [np.where(log_scaled, np.log(x), x)
+                                 for x in (low, high, values)]
+        width = high - low
+        return np.where(width > 0, 2*(values - low)/np.where(width > 0,
+                                                             width, 1) - 1,
+                        0.0)
+
+    def in_domain(self, inputs:Dict[str, float]) -> bool:
+        """
+        Whether the inputs are inside the training box, with the (left, mode,
+        right) values of every triangular distribution sorted as in the
+        training design.
+        """
+        for name in TRIANGULAR_INPUTS:
+            left, mode, right = [np.ravel(inputs["{}_{}".format(name, point)])
+                                 for point in ("left", "mode", "right")]
+            if np.any((left > mode) | (mode > right)):
+                return False
+        return bool(np.all(np.abs(self.scale(inputs)) <= 1 + 1e-9))
+
+    def predict(self, inputs:Dict[str, Union[float, np.ndarray]]
+                ) -> Dict[str, np.ndarray]:
+        """
+        Predicted SURROGATE_OUTPUTS, with the quantiles of every metric
+        sorted so that they do not cross.
+        """
+        predictions = legendre_features(self.scale(inputs), self.exponents) \
+                      @ self.coefficients
+        n_quantiles = len(SURROGATE_QUANTILES)
+        predictions = np.sort(predictions.reshape(len(predictions), -1,
+                                                  n_quantiles), axis=-1)
+        return dict(zip(SURROGATE_OUTPUTS,
+                        predictions.reshape(len(predictions), -1).T))
+
+    def report(self) -> List[tuple]:
+        """
+        Held-out error report, rows of ERROR_COLUMNS.
+        """
+        return [(output, *errors) for output, errors in
+                zip(SURROGATE_OUTPUTS, self.error_report)]
+
+    def save(self, path:Optional[str] = None):
+        """
+        Saves the surrogate (to `surrogate_path` by default).
+        """
+        path = path or surrogate_path(self.electrolyser_type, self.version)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        metadata = {"electrolyser_type": self.electrolyser_type,
+                    "bounds": self.bounds,
+                    "base_prices": self.base_prices,
+                    "version": self.version}
+        np.savez(path,
+                 metadata=json.dumps(metadata),
+                 exponents=self.exponents,
+                 coefficients=self.coefficients,
+                 error_report=self.error_report)
+
+    @classmethod
+    def load(cls, path:str) -> "Surrogate":
+        with np.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            return cls(metadata["electrolyser_type"],
+                       {name: tuple(bounds) for name, bounds in
+                        metadata["bounds"].items()},
+                       data["exponents"],
+                       data["coefficients"],
+                       data["error_report"],
+                       {name: tuple(points) for name, points in
+                        metadata["base_prices"].items()},
+                       metadata["version"])
+
+
+def load_surrogate(electrolyser_type:str,
+                   base_prices:Optional[Dict[str, tuple]] = None,
+                   directory:str = SURROGATE_DIRECTORY
+                   ) -> Optional[Surrogate]:
+    """
+    Loads the surrogate of the current parameter file version, None if there
+    is none or it was trained with other base price curves.
+    """
+    path = surrogate_path(electrolyser_type, directory=directory)
+    if not os.path.exists(path):
+        return None
+    surrogate = Surrogate.load(path)
+    if base_prices is not None and \
+            json.loads(json.dumps(base_prices)) != \
+            json.loads(json.dumps(surrogate.base_prices)):
+        return None
+    return surrogate
+
+
+def design_inputs(n:int, bounds:Dict[str, Tuple[float, float]],
+                  rng:np.random.Generator) -> Dict[str, np.ndarray]:
+    """
+    Random design points in the training box. The (left, mode, right)
+    values of every triangular distribution are three sorted uniform draws.
+    """
+    design = {}
+    for name in SURROGATE_INPUTS:
+        low, high = bounds[name]
+        design[name] = rng.uniform(low, high, n)
+    for name in TRIANGULAR_INPUTS:
+        points = ["{}_{}".format(name, point) for point in
+                  ("left", "mode", "right")]
+        values = np.sort(np.column_stack([design[point] for point in points]),
+                         axis=1)
+        design.update(zip(points, values.T))
+    return design
+
+
+def simulate_outputs(electrolyser_type:str,
+                     design:Dict[str, np.ndarray],
+                     base_prices:Dict[str, Tuple[Sequence, Sequence, str]],
+                     samples:int = 200,
+                     seed:Optional[int] = None,
+                     max_elements:int = 4_000_000) -> np.ndarray:
+    """
+    Monte Carlo quantiles of the metrics at every design point.
+
+    All the design points use the same uniform draws (common random
+    numbers), so the simulated outputs vary smoothly between the points.
+    The draws are stratified, the quantiles of a few samples would
+    otherwise be biased the same way at every point.
+
+    Returns:
+    -------
+    np.ndarray -> (points, outputs) SURROGATE_OUTPUTS
+    """
+    rng = np.random.default_rng(seed)
+    # Latin hypercube draws, so the few samples of every point cover the
+    # distributions evenly
+    uniforms = {name: (rng.permutation(samples) + rng.random(samples))/samples
+                for name in TRIANGULAR_INPUTS}
+    curves = {name: interpolate.interp1d(points[0], points[1],
+                                         kind=points[2],
+                                         fill_value="extrapolate")
+              for name, points in base_prices.items()}
+
+    n_points = len(design["E_o"])
+    outputs = np.empty((n_points, len(SURROGATE_OUTPUTS)))
+    for points in batch_blocks(n_points,
+                               electrolyser_type,
+                               np.max(design["lifetime_right"]),
+                               np.min(design["rate_of_use"]),
+                               samples,
+                               max_elements):
+        block = {name: values[points, None]
+                 for name, values in design.items()}
+        sampled = {name: triangular_ppf(uniforms[name],
+                                        block[name + "_left"],
+                                        block[name + "_mode"],
+                                        block[name + "_right"])
+                   for name in TRIANGULAR_INPUTS}
+        results = profitability_batch(
+                        sampled["efficiency"],
+                        block["efficiency_reduction_rate"],
+                        sampled["capital_cost"] * block["E_o"],
+                        sampled["lifetime"],
+                        block["E_o"],
+                        electrolyser_type,
+                        block["rate_of_use"],
+                        block["discount_rate"],
+                        curves["E_cost"],
+                        curves["hydrogen_price"],
+                        curves["water_price"],
+                        E_cost_scale=block["E_cost_level"],
+                        hydrogen_price_scale=block["hydrogen_price_level"],
+                        water_price_scale=block["water_price_level"],
+                        metrics=set(SURROGATE_METRICS.values()))
+        results["IRR"] = results["IRR"] * 100
+
+        # All-NaN rows give a NaN quantile, left out of the fit
+        outputs[points] = np.hstack([
+                        sample_quantile(results[engine_metric],
+                                        SURROGATE_QUANTILES, axis=1).T
+                        for engine_metric in SURROGATE_METRICS.values()])
+    return outputs
+
+
+def fit_coefficients(features:np.ndarray, outputs:np.ndarray,
+                     ridge:float = 1e-8) -> np.ndarray:
+    """
+    Ridge least squares coefficients of every output, ignoring the design
+    points where the output is NaN.
+    """
+    coefficients = np.empty((features.shape[1], outputs.shape[1]))
+    regularization = ridge * np.eye(features.shape[1])
+    for k in range(outputs.shape[1]):
+        valid = ~np.isnan(outputs[:, k])
+        gram = features[valid].T @ features[valid]
+        coefficients[:, k] = np.linalg.solve(
+                        gram + regularization * np.trace(gram),
+                        features[valid].T @ outputs[valid, k])
+    return coefficients
+
+
+def error_report(predictions:np.ndarray, outputs:np.ndarray) -> np.ndarray:
+    """
+    RMSE, MAE, max error and R2 of every output over the valid points.
+    """
+    report = np.empty((outputs.shape[1], 4))
+    for k in range(outputs.shape[1]):
+        valid = ~np.isnan(outputs[:, k])
+        errors = predictions[valid, k] - outputs[valid, k]
+        variance = np.var(outputs[valid, k])
+        report[k] = (np.sqrt(np.mean(errors**2)),
+                     np.mean(np.abs(errors)),
+                     np.max(np.abs(errors)),
+                     1 - np.mean(errors**2)/variance if variance > 0 \
+                     else np.nan)
+    return report
+
+
+def train_surrogate(electrolyser_type:str,
+                    base_prices:Dict[str, Tuple[Sequence, Sequence, str]],
+                    points:int = 3000,
+                    samples:int = 100,
+                    degree:int = 3,
+                    held_out:float = 0.2,
+                    seed:Optional[int] = 0) -> Surrogate:
+    """
+    Trains the surrogate of an electrolyser type on Monte Carlo simulations
+    at random design points, and reports its error on the held-out points.
+
+    Arguments:
+    ---------
+    electrolyser_type: str -> Electrolyser type
+
+    base_prices: dict -> (years, values, interpolation kind) control points
+        of the "E_cost", "hydrogen_price" and "water_price" base curves
+
+    points: int -> Number of design points
+
+    samples: int -> Monte Carlo samples per design point
+
+    degree: int -> Total degree of the polynomial expansion
+
+    held_out: float -> Fraction of the design points kept for the error
+        report
+
+    seed: int -> Seed of the design and of the samples
+
+    Returns:
+    -------
+    Surrogate -> Fitted on the training points
+    """
+    rng = np.random.default_rng(seed)
+    bounds = input_bounds(electrolyser_type)
+    base_prices = {name: (list(years), list(values), kind)
+                   for name, (years, values, kind) in base_prices.items()}
+
+    design = design_inputs(points, bounds, rng)
+    outputs = simulate_outputs(electrolyser_type, design, base_prices,
+                               samples, seed)
+
+    surrogate = Surrogate(electrolyser_type, bounds,
+                          total_degree_exponents(len(SURROGATE_INPUTS),
+                                                 degree),
+                          None, None, base_prices, params_version())
+    features = legendre_features(surrogate.scale(design), surrogate.exponents)
+
+    test = np.arange(points) < int(held_out * points)
+    surrogate.coefficients = fit_coefficients(features[~test],
+                                              outputs[~test])
+    predictions = np.column_stack(list(surrogate.predict(
+                        {name: values[test] for name, values in
+                         design.items()}).values()))
+    surrogate.error_report = error_report(predictions, outputs[test])
+    return surrogate
+
+
+if __name__ == "__main__":
+    # Offline training: python surrogate.py prices.json [types]
+    # prices.json holds the base control points, e.g.
+    # {"E_cost": [[2022, 2030], [0.05, 0.03], "linear"], ...}
+    with open(sys.argv[1]) as prices_file:
+        base_prices = json.load(prices_file)
+    with open(PARAMS_FILE) as params_file:
+        electrolyser_types = sys.argv[2:] or list(json.load(params_file))
+
+    for electrolyser_type in electrolyser_types:
+        surrogate = train_surrogate(electrolyser_type, base_prices)
+        surrogate.save()
+        print(electrolyser_type)
+        for row in surrogate.report():
+            print("  {:<12} RMSE {:.4g}  MAE {:.4g}  max {:.4g}  R2 {:.4f}"
+                  .format(*row))
@@ -0,0 +1,23 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from compute_service import ComputeService
+
+
+def test_crashed_worker_is_replaced():
+    service = ComputeService(max_workers=2)
+    try:
+        assert service.submit("a", "warm", pow, 2, 1).result(timeout=60) == 2
+        # The worker process dies while running the request of session "a"
+        with pytest.raises(BrokenProcessPool):
+            service.submit("a", "crash", os._exit, 1).result(timeout=60)
+
+        futures = [service.submit(session_id, ("pow", i), pow, 2, i)
+                   for i, session_id in enumerate("abcd")]
+        assert [future.result(timeout=60) for future in futures] == \
+               [1, 2, 4, 8]
+        assert service.running == 0
+    finally:
+        service.shutdown()
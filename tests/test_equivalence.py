@@ -0,0 +1,8 @@
+import pytest
+
+from equivalence import ENGINES, assert_equivalent
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_engine_matches_reference(engine):
+    assert_equivalent([engine], scenarios=4, cases=40, seed=0)
@@ -0,0 +1,21 @@
+import numpy as np
+
+from functions import calculate_profitability_V3, profitability_batch
+
+
+def scalar_energy_cost(year):
+    # A curve that only takes one year at a time
+    return 0.05 if year < 2030 else 0.03
+
+
+def test_scalar_price_curves():
+    args = (55, 0.01, 1.2e7, 75, 10000, "PEM", 0.5, 0.07)
+    curves = (scalar_energy_cost, lambda year: 5.0, lambda year: 2.0)
+    ROI, IRR, payback, LCOH = calculate_profitability_V3(*args, *curves)
+
+    batch = profitability_batch(*args, *curves,
+                                metrics=("ROI", "IRR", "payback", "LCOH"))
+    assert np.isclose(batch["ROI"], ROI)
+    assert np.isclose(batch["IRR"], IRR)
+    assert batch["payback"] == payback
+    assert np.isclose(batch["LCOH"], LCOH)
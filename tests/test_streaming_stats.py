@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from streaming_stats import BootstrapMean, MetricSummary, QuantileSketch
+
+
+@pytest.mark.parametrize("n", [50, 150, 1000])
+def test_bootstrap_mean_ci_coverage(n):
+    rng = np.random.default_rng(0)
+    trials = 200
+    covered = 0
+    for trial in range(trials):
+        bootstrap = BootstrapMean(replicates=500, seed=trial)
+        bootstrap.update(rng.normal(10.0, 2.0, n))
+        low, high = bootstrap.ci(0.95)
+        assert high > low
+        covered += low <= 10.0 <= high
+    # Nominal 95%, the binomial error of 200 trials is about 1.5%
+    assert covered / trials >= 0.90
+
+
+def test_bootstrap_mean_ci_chunks():
+    rng = np.random.default_rng(1)
+    values = rng.normal(0.0, 1.0, 20000)
+    bootstrap = BootstrapMean(replicates=1000, seed=0)
+    for chunk in np.array_split(values, 7):
+        bootstrap.update(chunk)
+    low, high = bootstrap.ci(0.95)
+    # Width of the normal interval 2*1.96*sigma/sqrt(n)
+    assert (high - low) == pytest.approx(2*1.96/np.sqrt(values.size),
+                                         rel=0.15)
+
+
+def test_paired_bootstrap_mean_ci():
+    # Antithetic pairs of a monotone function: the pair means vary much less
+    # than the samples, so the paired interval is narrower and still covers
+    rng = np.random.default_rng(2)
+    trials = 200
+    covered = 0
+    for trial in range(trials):
+        u = rng.random(500)
+        values = np.exp(np.concatenate([u, 1 - u]))
+        summary = MetricSummary(replicates=500, seed=trial, paired=True)
+        summary.update(values)
+        low, high = summary.mean_ci(0.95)
+        covered += low <= np.e - 1 <= high
+        independent = BootstrapMean(replicates=500, seed=trial)
+        independent.update(values)
+        independent_low, independent_high = independent.ci(0.95)
+        assert high - low < (independent_high - independent_low) / 3
+    assert covered / trials >= 0.90
+
+
+@pytest.mark.parametrize("k", [200, 1000])
+def test_quantile_sketch_rank_error(k):
+    q = np.arange(1, 1000) / 1000
+    for trial in range(5):
+        values = np.random.default_rng(trial).normal(size=100000)
+        sketch = QuantileSketch(k, seed=trial)
+        for chunk in np.array_split(values, 200):
+            sketch.update(chunk)
+        sorted_values = np.sort(values)
+
+        # The true ranks of the estimated quantiles bracket q
+        estimates = sketch.quantile(q)
+        low = np.searchsorted(sorted_values, estimates, side="left")
+        high = np.searchsorted(sorted_values, estimates, side="right")
+        assert np.all(low / values.size - q <= sketch.rank_error)
+        assert np.all(q - high / values.size <= sketch.rank_error)
+
+        items, fraction = sketch.ecdf()
+        true_fraction = np.searchsorted(sorted_values, items,
+                                        side="right") / values.size
+        assert np.max(np.abs(fraction - true_fraction)) <= sketch.rank_error
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from variance_reduction import triangular_ppf, triangular_inverse_mean
+
+
+@pytest.mark.parametrize("distribution", [(50, 45, 60), (60, 55, 50)])
+def test_unsorted_triangular_raises(distribution):
+    with pytest.raises(ValueError):
+        triangular_ppf(np.array([0.1, 0.5, 0.9]), *distribution)
+    with pytest.raises(ValueError):
+        triangular_inverse_mean(*distribution)
+
+
+def test_triangular_ppf_stays_in_range():
+    values = triangular_ppf(np.linspace(0, 1, 101), 50, 55, 60)
+    assert values.min() == 50 and values.max() == 60
+    assert triangular_ppf(0.3, 50, 50, 50) == 50
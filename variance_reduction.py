@@ -0,0 +1,271 @@
+import numpy as np
+from typing import *
+
+from functions import get_cost_model, operating_schedule, price_schedule,\
+                      batch_gradients, HOURS_PER_YEAR
+
+# Variance reduction of the Monte Carlo estimates of the mean ROI, NPV and
+# hydrogen cost.
+#
+# Antithetic pairing: every uniform draw u of the inverse transform of the
+# triangular distributions is paired with 1 - u. The metrics are monotone
+# in the sampled inputs, so the two halves of a pair are negatively
+# correlated and the pair means vary less than independent samples.
+#
+# Control variates: the sample mean is corrected with quantities of known
+# expectation that are strongly correlated with the metric,
+#   - the first order expansion of the metric at the triangular modes (the
+#     deterministic case) with the analytic gradients, whose expectation
+#     follows from the means of the triangular distributions, and
+#   - the undiscounted total cash flow, whose expectation has a closed form
+#     because it is linear in 1/efficiency and in the CAPEX, and the
+#     lifetime only sets the number of operating years.
+
+ESTIMATORS = ("plain", "antithetic", "control variates",
+              "antithetic control variates")
+
+# Mean metrics with a variance reduced estimator
+ESTIMATED_METRICS = ("ROI", "NPV", "LCOH")
+
+ESTIMATE_COLUMNS = ("metric", "mean", "standard error", "variance reduction",
+                    "equivalent samples")
+
+
+def check_triangular(left:Union[float, np.ndarray],
+                     mode:Union[float, np.ndarray],
+                     right:Union[float, np.ndarray]):
+    """
+    Raises a ValueError unless left <= mode <= right.
+    """
+    if not np.all((np.asarray(left) <= mode) & (np.asarray(mode) <= right)):
+        raise ValueError("A triangular distribution needs left <= mode <= "
+                         "right, got ({}, {}, {})".format(left, mode, right))
+
+
+def triangular_ppf(u:Union[float, np.ndarray], left:float, mode:float,
+                   right:float) -> Union[float, np.ndarray]:
+    """
+    Inverse of the cumulative distribution function of a triangular
+    distribution. The parameters can be arrays broadcast with the draws.
+    """
+    check_triangular(left, mode, right)
+    u, left, mode, right = np.broadcast_arrays(
+                            *[np.asarray(x, dtype=float) for x in
+                              (u, left, mode, right)])
+    width = right - left
+    # A point distribution (zero width) returns its right end
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mode_fraction = np.where(width > 0, (mode - left) / width, 0.0)
+    return np.where(u < mode_fraction,
+                    left + np.sqrt(u * width * (mode - left)),
+                    right - np.sqrt((1 - u) * width * (right - mode)))
+
+
+def triangular_cdf(x:Union[float, np.ndarray], left:float, mode:float,
+                   right:float) -> Union[float, np.ndarray]:
+    """
+    Cumulative distribution function of a triangular distribution.
+    """
+    check_triangular(left, mode, right)
+    x = np.asarray(x, dtype=float)
+    width = right - left
+    if width == 0:
+        return np.where(x < left, 0.0, 1.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rising = (x - left)**2 / (width * (mode - left))
+        falling = 1 - (right - x)**2 / (width * (right - mode))
+    return np.select([x <= left, x <= mode, x < right],
+                     [0.0, rising, falling], 1.0)
+
+
+def triangular_mean(left:float, mode:float, right:float) -> float:
+    """
+    Mean of a triangular distribution.
+    """
+    return (left + mode + right) / 3
+
+
+def triangular_inverse_mean(left:float, mode:float, right:float) -> float:
+    """
+    Mean of the inverse, E[1/X], of a triangular distribution with positive
+    support.
+    """
+    check_triangular(left, mode, right)
+    if right == left:
+        return 1 / left
+
+    def log_ratio(low, high, weight):
+        # weight*log(high/low)/(high - low), 1 in the limit high -> low
+        return weight * np.log(high / low) / (high - low) if high > low \
+               else 1.0
+
+    return 2 / (right - left) * (log_ratio(mode, right, right) - \
+                                 log_ratio(left, mode, left))
+
+
+def antithetic_uniforms(rng:np.random.Generator, n:int) -> np.ndarray:
+    """
+    Antithetic uniform draws: ceil(n/2) draws u followed by their pairs
+    1 - u, so the sample i is paired with the sample i + ceil(n/2).
+    """
+    u = rng.random(-(-n // 2))
+    return np.concatenate([u, 1 - u])
+
+
+def expected_cash_flow(distributions:Dict[str, Tuple[float, float, float]],
+                       efficiency_reduction_rate:float,
+                       E_o:float,
+                       electrolyser_type:str,
+                       rate_of_use:float,
+                       E_cost:Callable,
+                       hydrogen_price:Callable,
+                       water_price:Callable) -> float:
+    """
+    Closed form expectation of the undiscounted total cash flow over the
+    operating years, when the efficiency, lifetime and CAPEX_sys are
+    independent triangular distributions (left, mode, right).
+
+    The cash flow of the operating year p is
+
+        cf_p = E_year * (a_p/(efficiency * (1 + g)**(p - 1)) - e_p) - OPEX,
+
+    linear in 1/efficiency and in the CAPEX, and the year p is operated when
+    the lifetime in years is at least p - 1.
+    """
+    for distribution in distributions.values():
+        check_triangular(*distribution)
+    cost_model = get_cost_model(electrolyser_type)
+    lifetime = distributions["lifetime"]
+
+    periods = np.arange(1, cost_model.lifetime_years(lifetime[2],
+                                                     rate_of_use) + 2)
+    years = 2022 + periods
+    # Probability that the lifetime covers p - 1 whole years
+    operated = 1 - triangular_cdf((periods - 1) * rate_of_use * \
+                                  HOURS_PER_YEAR / 1000, *lifetime)
+    operated[0] = 1.0
+
+    degradation = cost_model.degradation_per_year(efficiency_reduction_rate,
+                                                   rate_of_use)
+    E_year = E_o * rate_of_use * HOURS_PER_YEAR
+    a = price_schedule(years, hydrogen_price) - \
+        9 * price_schedule(years, water_price) / 997
+    expected_flows = E_year * (a * triangular_inverse_mean(
+                                            *distributions["efficiency"]) / \
+                               (1 + degradation)**(periods - 1) - \
+                               price_schedule(years, E_cost)) - \
+                     cost_model.opex_fraction(E_o) * \
+                     triangular_mean(*distributions["CAPEX_sys"])
+    return float(np.sum(operated * expected_flows))
+
+
+def mode_linearization(distributions:Dict[str, Tuple[float, float, float]],
+                       efficiency_reduction_rate:float,
+                       E_o:float,
+                       electrolyser_type:str,
+                       rate_of_use:float,
+                       discount_rate:float,
+                       E_cost:Callable,
+                       hydrogen_price:Callable,
+                       water_price:Callable
+                       ) -> Dict[str, Dict[str, float]]:
+    """
+    Derivatives of the NPV, ROI and LCOH of the deterministic case (all the
+    sampled inputs at their modes) with respect to the sampled inputs.
+
+    Returns:
+    -------
+    dict -> {metric: {sampled input: derivative}}
+    """
+    # One case schedule, the schedule needs arrays
+    modes = {name: np.array([distribution[1]]) for name, distribution in
+             distributions.items()}
+    schedule = operating_schedule(modes["efficiency"],
+                                  efficiency_reduction_rate,
+                                  modes["CAPEX_sys"],
+                                  modes["lifetime"],
+                                  E_o,
+                                  electrolyser_type,
+                                  rate_of_use)
+    years = schedule["years"]
+    gradients = batch_gradients(schedule,
+                                price_schedule(years, E_cost),
+                                price_schedule(years, hydrogen_price),
+                                price_schedule(years, water_price),
+                                discount_rate)
+    return {metric: {name: float(gradients[metric][name][0])
+                     for name in distributions}
+            for metric in ESTIMATED_METRICS}
+
+
+def linear_control(samples:Dict[str, np.ndarray],
+                   derivatives:Dict[str, float],
+                   distributions:Dict[str, Tuple[float, float, float]]
+                   ) -> np.ndarray:
+    """
+    First order expansion of a metric around the means of the sampled
+    inputs, a control variate of zero expectation.
+    """
+    return sum(derivative * (samples[name] - \
+                             triangular_mean(*distributions[name]))
+               for name, derivative in derivatives.items())
+
+
+def controlled_mean(values:np.ndarray,
+                    controls:Optional[np.ndarray] = None,
+                    control_means:Optional[np.ndarray] = None,
+                    antithetic:bool = False) -> dict:
+    """
+    Mean of the samples of a metric with antithetic pairs and/or control
+    variates (regression estimator).
+
+    Arguments:
+    ---------
+    values: np.ndarray -> Metric by sample
+
+    controls: np.ndarray -> (samples, controls) control variates, None for
+        no control
+
+    control_means: np.ndarray -> Known expectation of every control
+
+    antithetic: bool -> The sample i is paired with the sample
+        i + len(values)/2
+
+    Returns:
+    -------
+    dict -> "mean", "standard error", "variance reduction" (variance of the
+        plain sample mean over the variance of the estimator) and
+        "equivalent samples" (plain samples with the same precision)
+    """
+    values = np.asarray(values, dtype=float)
+    n = values.size
+    controls = np.zeros((n, 0)) if controls is None else \
+               np.asarray(controls, dtype=float).reshape(n, -1)
+    control_means = np.zeros(controls.shape[1]) if control_means is None \
+                    else np.asarray(control_means, dtype=float)
+
+    # The estimation units are the pair means of the antithetic pairs
+    units, unit_controls = values, controls
+    if antithetic:
+        half = n // 2
+        units = (values[:half] + values[half:]) / 2
+        unit_controls = (controls[:half] + controls[half:]) / 2
+
+    centered = units - units.mean()
+    centered_controls = unit_controls - unit_controls.mean(axis=0)
+    coefficients = np.linalg.lstsq(centered_controls, centered,
+                                   rcond=None)[0]
+    residuals = centered - centered_controls @ coefficients
+
+    mean = units.mean() - (unit_controls.mean(axis=0) - control_means) @ \
+           coefficients
+    dof = max(units.size - controls.shape[1] - 1, 1)
+    variance = np.sum(residuals**2) / dof / units.size
+    plain_variance = np.var(values, ddof=1) / n if n > 1 else np.nan
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        reduction = plain_variance / variance
+    return {"mean": mean,
+            "standard error": np.sqrt(variance),
+            "variance reduction": reduction,
+            "equivalent samples": reduction * n}